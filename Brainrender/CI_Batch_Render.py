@@ -0,0 +1,158 @@
+# brainrender script for rendering screenshots of many brains and region sets offscreen, in parallel
+
+# Author: 	Luke Hammond
+# Cellular Imaging | Zuckerman Institute, Columbia University
+# Date:	18th October, 2026
+
+# Usage:
+#   python CI_Batch_Render.py manifest.json --processes 8
+#
+# The manifest (json) lists the brains, region sets and cameras - every brain is rendered for every
+# region set, with one screenshot per camera:
+# {
+#   "output": "C:/Users/Luke_H/Desktop/Renders",
+#   "atlas": "allen_mouse_25um",
+#   "cameras": ["three_quarters", "top", "sagittal"],
+#   "zoom": 1,
+#   "mesh_level": 1,
+#   "include_children": true,
+#   "brains": [
+#     {"name": "1267", "cells": ".../haloperidol/1267/cells.csv", "layout": "ClearMap", "color": "magenta"},
+#     {"name": "1272", "cells": ".../Saline/1272/cells.csv", "layout": "ClearMap", "color": "springgreen"}
+#   ],
+#   "region_sets": [
+#     {"name": "striatum", "regions": [672], "acronyms": [], "brain_regions": ["CP", "STR"]},
+#     {"name": "cortex", "regions": [], "acronyms": ["MOs", "MOp"], "brain_regions": ["MOs", "MOp", "SS"]}
+#   ]
+# }
+# Screenshots are saved as <output>/<brain>_<region set>_<camera>.png
+# mesh_level picks the region meshes of the bundle: 0 = full atlas meshes (default), 1 and 2 = decimated.
+#
+# Each worker process has its own offscreen VTK context and memory maps the atlas mesh bundle
+# (see CI_Meshes.py) once, so region meshes are not reloaded for each job. On a headless Linux machine use a VTK build with
+# offscreen support (OSMesa/EGL), or run under xvfb-run.
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+from rich import print
+from myterial import orange
+
+#atlas mesh bundle of this worker process
+_bundle = None
+
+
+def init_worker(atlas):
+    #runs once in each worker process - offscreen rendering with the manifest atlas
+    global _bundle
+    import brainrender
+
+    from CI_Meshes import load_mesh_bundle
+
+    brainrender.settings.OFFSCREEN = True
+    brainrender.settings.WHOLE_SCREEN = False
+    brainrender.settings.SHOW_AXES = False
+    brainrender.settings.SHADER_STYLE = "plastic"
+    brainrender.settings.DEFAULT_ATLAS = atlas
+    brainrender.settings.SCREENSHOT_SCALE = 1
+    brainrender.settings.ROOT_ALPHA = 0.2
+    _bundle = load_mesh_bundle(atlas)
+
+
+def render_job(job):
+    #render one brain x region set for all cameras - returns (job name, files or error)
+    import brainrender
+
+    from CI_Cell_Loader import read_in_cells
+    from CI_Meshes import add_region, make_scene
+    from CI_Points_LOD import add_cells
+    from CI_Regions import load_hierarchy, region_acronyms
+
+    brain, region_set, manifest = job["brain"], job["region_set"], job["manifest"]
+    name = f"{brain['name']}_{region_set['name']}"
+    try:
+        hierarchy = load_hierarchy(brainrender.settings.DEFAULT_ATLAS)
+        coordinates = read_in_cells(brain["cells"], brain.get("layout", "BrainJ"),
+                                    region_set.get("regions", []), region_set.get("acronyms", []),
+                                    hierarchy=hierarchy if manifest.get("include_children", True) else None)
+
+        scene = make_scene(_bundle, level=manifest.get("mesh_level", 0))
+        for acronym in region_acronyms(hierarchy, region_set.get("brain_regions", [])):
+            add_region(scene, _bundle, acronym, alpha=0.35)
+        add_cells(scene, coordinates, name="Cells", colors=brain.get("color", "steelblue"),
+                  alpha=brain.get("alpha", 1), zoom_levels=False)
+
+        files = []
+        for camera in manifest.get("cameras", ["three_quarters"]):
+            filename = os.path.join(manifest["output"], f"{name}_{camera}.png")
+            scene.render(interactive=False, camera=camera, zoom=manifest.get("zoom", 1))
+            scene.screenshot(name=filename)
+            files.append(filename)
+        scene.close()
+        return name, files, None
+    except Exception as error:
+        #report and continue with the other jobs
+        return name, [], f"{type(error).__name__}: {error}"
+
+
+def make_jobs(manifest):
+    return [dict(brain=brain, region_set=region_set, manifest=manifest)
+            for brain in manifest["brains"] for region_set in manifest["region_sets"]]
+
+
+def run_batch(manifest, processes=None):
+    #render all jobs in a pool of worker processes - returns the list of failed jobs
+    os.makedirs(manifest["output"], exist_ok=True)
+    jobs = make_jobs(manifest)
+    processes = processes or os.cpu_count()
+    print(f"[{orange}]Rendering {len(jobs)} scenes with {processes} processes")
+
+    #build the mesh bundle and hierarchy cache here (if needed) rather than in every worker
+    from CI_Meshes import load_mesh_bundle
+    from CI_Regions import load_hierarchy
+    atlas = manifest.get("atlas", "allen_mouse_25um")
+    load_mesh_bundle(atlas)
+    load_hierarchy(atlas)
+
+    #build each cell cache here too - concurrent workers would all build the same cache on the first run
+    from CI_Cell_Loader import load_cell_cache
+    built = []
+    for brain in manifest["brains"]:
+        cells, layout = brain["cells"], brain.get("layout", "BrainJ")
+        if (cells, layout) in built:
+            continue
+        built.append((cells, layout))
+        try:
+            load_cell_cache(cells, layout)
+        except Exception as error:
+            #the jobs of this brain report the error
+            print(f"[red]Cell cache for {cells} not built - {type(error).__name__}: {error}")
+
+    failed = []
+    start = time.time()
+    #spawn - each worker creates its own VTK context
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes, initializer=init_worker, initargs=(atlas,)) as pool:
+        for i, (name, files, error) in enumerate(pool.imap_unordered(render_job, jobs), 1):
+            if error is None:
+                print(f"{i}/{len(jobs)} {name}: {len(files)} screenshots")
+            else:
+                print(f"{i}/{len(jobs)} {name}: [red]failed - {error}")
+                failed.append((name, error))
+    print(f"[{orange}]Done in {time.time() - start:.0f}s, {len(failed)} failed")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render brainrender screenshots for a manifest of brains and region sets")
+    parser.add_argument("manifest", help="json manifest of brains, region sets and cameras")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    failed = run_batch(manifest, args.processes)
+    raise SystemExit(1 if failed else 0)
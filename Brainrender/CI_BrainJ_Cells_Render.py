@@ -7,16 +7,18 @@
 import numpy as np
 
 import brainrender
-from brainrender import Scene
-from brainrender.actors import Points, PointsDensity
+from brainrender.actors import PointsDensity
 
 
 from rich import print
 from myterial import orange
 from pathlib import Path
 
-# Import Pandas to read in csv
-import pandas as pd
+# Import shared loader to read in csv
+from CI_Cell_Loader import read_in_BrainJ_cells
+from CI_Regions import load_hierarchy, region_acronyms
+from CI_Points_LOD import add_cells
+from CI_Meshes import load_mesh_bundle, make_scene, add_region
 
 print(f"[{orange}]Running example: {Path(__file__).name}")
 
@@ -40,61 +42,42 @@ brainrender.settings.ROOT_ALPHA = 0.2  # transparency of the overall brain model
 regions = [767]
 acronyms = ["MOs5"]
 
+#Include cells in child regions of the regions/acronyms above (e.g. "MOs" also includes "MOs5")
+include_children = True
+hierarchy = load_hierarchy(brainrender.settings.DEFAULT_ATLAS)
+
+#Brain regions to add to the scene - IDs or acronyms
+brain_regions = ["MOs", "SS", "MOp"]
+
 #MOs = 993
 #SS = 453
 #MOp = 985
 
 
 
-def read_in_BrainJ_cells(filename, regions, acronyms):
-    #this function reads in BrainJ csv files and can be used to filter to region at the same time
-    #use pandas to read in specific columns from BrainJ csv output file
-    cells = pd.read_csv(filename, usecols=[0,1,3,12,13], names = ['X','Y','Z','ID','Ac'], #, usecols=col_list)
-                          skiprows = [0]) #skip header row
-    
-    #Filter based on regions array 
-    if len(regions) > 0:
-      cells = cells[cells['ID'].isin(regions)]
-    #print(cells)
-    
-    #Filter cells in specific region using acronyms array
-    if len(acronyms) > 0:
-      cells = cells[cells['Ac'].isin(acronyms)]
-    #print(cells)
-    
-   
-    #create lists from cells table - note swapping X and Y axes to match brainrender orientation
-    Z = cells['X'].tolist()
-    Y = cells['Y'].tolist()
-    X = cells['Z'].tolist()
-    
-    
-    #data is in voxels, so multiply by atlas resolution (25micronXYZ)
-    AtlasRes = 25
-    X = [element * AtlasRes for element in X]
-    Y = [element * AtlasRes for element in Y]
-    Z = [element * AtlasRes for element in Z]
-    pts = [[x, y, z] for x, y, z in zip(X, Y, Z)]
-    return np.vstack(pts)
 
 #use function to read in and filter cells
-coordinates1 = read_in_BrainJ_cells(cellsfile, regions, acronyms)
-#coordinates2 = read_in_BrainJ_cells(cellsfile2, regions, acronyms)
+coordinates1 = read_in_BrainJ_cells(cellsfile, regions, acronyms, hierarchy=hierarchy if include_children else None)
+#coordinates2 = read_in_BrainJ_cells(cellsfile2, regions, acronyms, hierarchy=hierarchy if include_children else None)
 
 #create the scene and give a title if required
-scene = Scene(title="Cells from BrainJ")
+#region meshes are loaded from a precomputed bundle for the atlas (created the first time it is used)
+#mesh level: 0 = full atlas meshes, 1 and 2 = decimated to 50% and 20% of the faces (faster to render)
+mesh_level = 0
+bundle = load_mesh_bundle(brainrender.settings.DEFAULT_ATLAS)
+scene = make_scene(bundle, level=mesh_level, title="Cells from BrainJ")
 # Setting a screenshot save directory
 #scene = Scene(title="Cells", screenshots_folder="C:\\Users\\Luke_H\\Documents\\GitHub") 
 #inset=True (False turns off brain outline)
 
 #add in the relevant brain regions - use acronyms as below
-scene.add_brain_region("MOs", alpha=0.35)
-scene.add_brain_region("SS", alpha=0.35)
-scene.add_brain_region("MOp", alpha=0.35)
+for region in region_acronyms(hierarchy, brain_regions):
+    add_region(scene, bundle, region, alpha=0.35)
 
 # Add to points to scene and give colour
-scene.add(Points(coordinates1, name="Cells", colors="steelblue"))
-#scene.add(Points(coordinates2, name="Cells", colors="salmon"))
+# large cell sets (>100k) are decimated and drawn as flat points, with more cells shown when zooming in
+add_cells(scene, coordinates1, name="Cells", colors="steelblue")
+#add_cells(scene, coordinates2, name="Cells", colors="salmon")
 
 # uncomment to add density to plot to scene
 #scene.add(PointsDensity(coordinates1))
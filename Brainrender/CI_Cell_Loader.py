@@ -0,0 +1,295 @@
+# shared cell table loader for the brainrender scripts (BrainJ and ClearMap)
+
+# Author: 	Luke Hammond
+# Cellular Imaging | Zuckerman Institute, Columbia University
+# Date:	18th October, 2026
+
+# Usage (from a script in this folder):
+#   from CI_Cell_Loader import read_in_BrainJ_cells, read_in_ClearMap_cells
+#   coordinates1 = read_in_BrainJ_cells(cellsfile, regions, acronyms)
+#
+# Only the needed columns are read, with fixed dtypes, and the coordinates are returned
+# as an (N,3) float32 array in atlas microns ready to pass to brainrender Points.
+#
+# The first time a csv file is read it is converted to a binary cache folder next to it
+# (e.g. C1_Detected_Cells.csv.cellcache) with the cells sorted by region ID, so changing
+# the regions/acronyms and rerunning a script only slices the cached coordinates.
+# The cache is rebuilt automatically when the csv file changes (size/modification time).
+#
+# Pass hierarchy=load_hierarchy(atlas_name) (see CI_Regions.py) to also keep cells in all child
+# regions of the given regions/acronyms, e.g. "MOs" includes "MOs5".
+#
+# For csv files too large to load at once, pass chunksize (rows per block, e.g. 1_000_000): the file
+# is streamed and only cells passing the filters are kept, so memory scales with the filtered output.
+# max_memory (bytes) stops with a MemoryError if the kept coordinates would grow beyond it.
+#
+# Parquet cell tables (e.g. cells.parquet from CellMap CI_Cell_Export.py) are read by column name
+# instead of column position - pass the .parquet file instead of the csv file.
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from CI_Regions import region_mask, select_structures
+
+#data is in voxels, so multiply by atlas resolution (25micronXYZ)
+AtlasRes = 25
+
+#column layouts of the csv files produced by each pipeline
+# usecols - positional columns for X, Y, Z, ID and acronym
+# axes - order of the X, Y, Z columns used to build brainrender (x, y, z) coordinates
+# drop_outside - remove cells with ID 0 (outside of the brain)
+# columns - names of the X, Y, Z, ID and acronym columns in parquet files
+COLUMNS = ['X', 'Y', 'Z', 'ID', 'Ac']
+
+LAYOUTS = {
+    # BrainJ: swap X and Z to match brainrender orientation
+    "BrainJ": dict(usecols=[0, 1, 3, 12, 13], axes=[2, 1, 0], drop_outside=False, columns=COLUMNS),
+    # ClearMap (modified cellmap protocol, with region IDs and acronyms included): swap X and Y
+    "ClearMap": dict(usecols=[5, 6, 7, 9, 10], axes=[1, 0, 2], drop_outside=True,
+                     columns=['xt', 'yt', 'zt', 'id', 'acronym']),
+}
+
+DTYPES = {'X': np.float32, 'Y': np.float32, 'Z': np.float32, 'ID': np.int32, 'Ac': 'category'}
+
+
+def get_layout(layout):
+    #accepts a layout name ("BrainJ"/"ClearMap") or a layout dictionary
+    if isinstance(layout, str):
+        try:
+            return LAYOUTS[layout]
+        except KeyError:
+            raise ValueError(f"Unknown cell table layout '{layout}', expected one of {list(LAYOUTS)}")
+    return layout
+
+
+def is_parquet(filename):
+    return str(filename).lower().endswith((".parquet", ".pq"))
+
+
+def read_parquet_table(filename, layout, chunksize=None):
+    #read the X, Y, Z, ID and acronym columns of a parquet file by name, renamed to COLUMNS
+    import pyarrow.parquet as pq
+
+    names = dict(zip(layout["columns"], COLUMNS))
+
+    def convert(table):
+        return table.to_pandas().rename(columns=names).astype(DTYPES)[COLUMNS]
+
+    parquet = pq.ParquetFile(filename)
+    if chunksize is not None:
+        return (convert(batch) for batch in parquet.iter_batches(batch_size=chunksize, columns=layout["columns"]))
+    return convert(parquet.read(columns=layout["columns"]))
+
+
+def read_cell_table(filename, layout, chunksize=None):
+    #read only the X, Y, Z, ID and acronym columns, with fixed dtypes, skipping the header row
+    #with chunksize, returns an iterator over blocks of chunksize rows instead of the full table
+    #parquet files are read by column name instead of position
+    layout = get_layout(layout)
+    if is_parquet(filename):
+        cells = read_parquet_table(filename, layout, chunksize)
+    else:
+        cells = pd.read_csv(filename, usecols=layout["usecols"], names=COLUMNS, dtype=DTYPES,
+                            skiprows=[0], header=None, engine="c", chunksize=chunksize)
+    if chunksize is not None:
+        return (drop_outside_cells(chunk, layout) for chunk in cells)
+    return drop_outside_cells(cells, layout)
+
+
+def drop_outside_cells(cells, layout):
+    if layout["drop_outside"]:
+        #Filter cells out side of the brain
+        cells = cells[cells['ID'].to_numpy() != 0]
+    return cells
+
+
+def filter_cells(cells, regions=(), acronyms=(), hierarchy=None):
+    #Filter cells in specific regions - by ID and/or by acronym (empty = keep all)
+    #with a hierarchy, child regions of the given regions and acronyms are included
+    if hierarchy is not None:
+        selected = select_structures(hierarchy, regions, acronyms)
+        if selected is None:
+            return cells
+        return cells[region_mask(hierarchy, cells['ID'].to_numpy(), selected)]
+    keep = np.ones(len(cells), dtype=bool)
+    if len(regions) > 0:
+        keep &= np.isin(cells['ID'].to_numpy(), np.asarray(regions, dtype=np.int64))
+    if len(acronyms) > 0:
+        keep &= cells['Ac'].isin(acronyms).to_numpy()
+    if keep.all():
+        return cells
+    return cells[keep]
+
+
+def cells_to_atlas(cells, layout, atlas_res=AtlasRes):
+    #convert the X, Y, Z voxel columns to an (N,3) float32 array in atlas microns
+    #axis swap and scaling are done in one numpy operation on the column block
+    return xyz_to_atlas(cells[['X', 'Y', 'Z']].to_numpy(dtype=np.float32), layout, atlas_res)
+
+
+def xyz_to_atlas(xyz, layout, atlas_res=AtlasRes):
+    #same as cells_to_atlas for an (N,3) X, Y, Z voxel array (e.g. from the cache)
+    layout = get_layout(layout)
+    return np.multiply(xyz[:, layout["axes"]], np.float32(atlas_res), dtype=np.float32)
+
+
+#%% Binary cell cache
+
+CACHE_VERSION = 1
+
+
+def cache_path(filename, cache_dir=None):
+    #cache folder for a csv file - next to the csv unless a cache directory is given
+    name = os.path.basename(filename) + ".cellcache"
+    if cache_dir is None:
+        return os.path.join(os.path.dirname(os.path.abspath(filename)), name)
+    return os.path.join(cache_dir, name)
+
+
+def source_signature(filename, layout):
+    #csv size and modification time, used to invalidate the cache
+    stat = os.stat(filename)
+    layout = get_layout(layout)
+    return dict(version=CACHE_VERSION, size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                usecols=list(layout["usecols"]), columns=list(layout.get("columns", COLUMNS)),
+                drop_outside=bool(layout["drop_outside"]))
+
+
+def cache_signature(path):
+    #signature of a complete cache folder, None if missing or incomplete
+    try:
+        with open(os.path.join(path, "signature.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build_cell_cache(cells, path, signature):
+    #write cells sorted by (ID, acronym) plus an index of the start offset of each (ID, acronym) block
+    ids = cells['ID'].to_numpy(dtype=np.int32)
+    codes = cells['Ac'].cat.codes.to_numpy().astype(np.int32)
+    order = np.lexsort((codes, ids))
+    ids, codes = ids[order], codes[order]
+    changed = np.ones(len(ids), dtype=bool)
+    changed[1:] = (ids[1:] != ids[:-1]) | (codes[1:] != codes[:-1])
+    starts = np.flatnonzero(changed)
+    offsets = np.append(starts, len(ids)).astype(np.int64)
+
+    #unique temporary folder, so processes building the same cache do not collide
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + ".tmp", dir=os.path.dirname(path))
+    np.save(os.path.join(tmp, "xyz.npy"), cells[['X', 'Y', 'Z']].to_numpy(dtype=np.float32)[order])
+    np.savez(os.path.join(tmp, "index.npz"), ids=ids[starts], codes=codes[starts], offsets=offsets,
+             acronyms=np.asarray(cells['Ac'].cat.categories, dtype=str))
+    #signature written last - a cache folder without it is incomplete and gets rebuilt
+    with open(os.path.join(tmp, "signature.json"), "w") as f:
+        json.dump(signature, f)
+    if cache_signature(path) == signature:
+        #built by another process in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        #lost the race to another process - fine if its cache is complete and current
+        shutil.rmtree(tmp, ignore_errors=True)
+        if cache_signature(path) != signature:
+            raise
+
+
+def load_cell_cache(filename, layout, cache_dir=None):
+    #returns the cache for a csv file, building it first if missing or out of date
+    path = cache_path(filename, cache_dir)
+    signature = source_signature(filename, layout)
+    if cache_signature(path) != signature:
+        build_cell_cache(read_cell_table(filename, layout), path, signature)
+
+    index = np.load(os.path.join(path, "index.npz"))
+    cache = {key: index[key] for key in index.files}
+    #coordinates are memory mapped so only the selected blocks are read from disk
+    cache["xyz"] = np.load(os.path.join(path, "xyz.npy"), mmap_mode="r")
+    return cache
+
+
+def select_cached_cells(cache, regions=(), acronyms=(), hierarchy=None):
+    #Filter cells in specific regions - by ID and/or by acronym - as slices of the sorted cache
+    if len(regions) == 0 and len(acronyms) == 0:
+        return np.asarray(cache["xyz"])
+    if hierarchy is not None:
+        keep = region_mask(hierarchy, cache["ids"], select_structures(hierarchy, regions, acronyms))
+    else:
+        keep = np.ones(len(cache["ids"]), dtype=bool)
+        if len(regions) > 0:
+            keep &= np.isin(cache["ids"], np.asarray(regions, dtype=np.int64))
+        if len(acronyms) > 0:
+            #code -1 (cells without an acronym) is no region, not the last acronym
+            names = np.append(cache["acronyms"], "")
+            keep &= np.isin(names[cache["codes"]], np.asarray(acronyms, dtype=str))
+    blocks = np.flatnonzero(keep)
+    offsets = cache["offsets"]
+    xyz = cache["xyz"]
+    if len(blocks) == 0:
+        return np.zeros((0, 3), dtype=np.float32)
+    return np.concatenate([xyz[offsets[b]:offsets[b + 1]] for b in blocks])
+
+
+#%% Chunked reading
+
+def read_in_cell_chunks(filename, layout, regions=(), acronyms=(), atlas_res=AtlasRes, hierarchy=None,
+                        chunksize=1_000_000, max_memory=None):
+    #stream the csv in blocks of chunksize rows, filter each block and keep only the surviving
+    #coordinates in a preallocated buffer that doubles in size when full
+    size = min(chunksize, 1_000_000)
+    if max_memory is not None:
+        size = min(size, max_memory // 12)
+    buffer = np.empty((size, 3), dtype=np.float32)
+    count = 0
+    for cells in read_cell_table(filename, layout, chunksize=chunksize):
+        xyz = cells_to_atlas(filter_cells(cells, regions, acronyms, hierarchy), layout, atlas_res)
+        if count + len(xyz) > len(buffer):
+            size = max(2 * len(buffer), count + len(xyz))
+            if max_memory is not None and size * buffer.itemsize * 3 > max_memory:
+                size = max_memory // (buffer.itemsize * 3)
+                if count + len(xyz) > size:
+                    raise MemoryError(f"Filtered cells from {filename} exceed max_memory ({max_memory} bytes)"
+                                      " - use a smaller set of regions or a larger max_memory")
+            grown = np.empty((size, 3), dtype=np.float32)
+            grown[:count] = buffer[:count]
+            buffer = grown
+        buffer[count:count + len(xyz)] = xyz
+        count += len(xyz)
+    return buffer[:count].copy() if count < len(buffer) // 2 else buffer[:count]
+
+
+def read_in_cells(filename, layout, regions=(), acronyms=(), atlas_res=AtlasRes, cache=True, cache_dir=None,
+                  hierarchy=None, chunksize=None, max_memory=None):
+    #read, filter and convert a cell csv file of the given layout
+    #cache=False reads the csv directly without creating/using the binary cache
+    #chunksize streams the csv in blocks of rows (the cache is not used)
+    if chunksize is not None:
+        return read_in_cell_chunks(filename, layout, regions, acronyms, atlas_res, hierarchy, chunksize, max_memory)
+    if cache:
+        xyz = select_cached_cells(load_cell_cache(filename, layout, cache_dir), regions, acronyms, hierarchy)
+        return xyz_to_atlas(xyz, layout, atlas_res)
+    cells = read_cell_table(filename, layout)
+    cells = filter_cells(cells, regions, acronyms, hierarchy)
+    return cells_to_atlas(cells, layout, atlas_res)
+
+
+def read_in_BrainJ_cells(filename, regions=(), acronyms=(), **options):
+    #this function reads in BrainJ csv files and can be used to filter to region at the same time
+    #options are passed to read_in_cells (atlas_res, cache, hierarchy, chunksize, max_memory)
+    return read_in_cells(filename, "BrainJ", regions, acronyms, **options)
+
+
+def read_in_ClearMap_cells(filename, regions=(), acronyms=(), **options):
+    #this function reads in ClearMap csv or parquet files and can be used to filter to region at the same time
+    #expects files created using modified cellmap protocol, with region IDs and acronyms included
+    #If orientation was flipped during processing in ClearMap (e.g. slicing
+    # orientation=(1,-2,3) vs orientation=(1,2,3)) then flip that axis of the returned array
+    return read_in_cells(filename, "ClearMap", regions, acronyms, **options)
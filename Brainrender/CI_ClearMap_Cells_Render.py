@@ -7,14 +7,16 @@
 import numpy as np
 
 import brainrender
-from brainrender import Scene
-from brainrender.actors import Points, PointsDensity
 from brainrender.actors import Volume
 
 from rich import print
 from myterial import orange
 from pathlib import Path
-import pandas as pd
+from CI_Cell_Loader import read_in_ClearMap_cells
+from CI_Regions import load_hierarchy, region_acronyms
+from CI_Points_LOD import add_cells
+from CI_Meshes import load_mesh_bundle, make_scene, add_region
+from CI_Density import cached_density_volumes
 
 #if making videos
 from brainrender import VideoMaker
@@ -34,6 +36,7 @@ print(f"[{orange}]Running example: {Path(__file__).name}")
 
 
 # Provide path to ClearMap cells csv file that you wish to plot
+# (or the cells.parquet file from the CellMap parquet export - read by column name)
 cellsfile1 = "C:/Users/Luke_H/Desktop/3_Brain_Visualization_Workshop/ClearMap/CellMap_Sa_cfos.csv"
 cellsfile2 = "C:/Users/Luke_H/Desktop/3_Brain_Visualization_Workshop/ClearMap/CellMap_Ha_cfos.csv"
 
@@ -42,50 +45,26 @@ cellsfile2 = "C:/Users/Luke_H/Desktop/3_Brain_Visualization_Workshop/ClearMap/Ce
 regions = [672]
 acronyms = ["CP"]
 
-def read_in_ClearMap_cells(filename, regions, acronyms):
-    #this function reads in ClearMap csv files and can be used to filter to region at the same time
-    #expects csv created using modified cellmap protocol, with region IDs and acronyms included
-    #use pandas to read in specific columns from BrainJ csv output file
-    cells = pd.read_csv(filename, usecols=[5,6,7,9,10], names = ['X','Y','Z','ID','Ac'], #, usecols=col_list)
-                          skiprows = [0]) #skip header row
-
-    #Filter cells out side of the brain
-    cells = cells[cells['ID'] != 0]
-    
-    #Filter cells in specific regions - by ID
-    if len(regions) > 0:
-      cells = cells[cells['ID'].isin(regions)]
-    
-    #Filter cells in specific region - by abbreviation
-    if len(acronyms) > 0:
-      cells = cells[cells['Ac'].isin(acronyms)]
-    #print(cells)
-
-    Y = cells['X'].tolist()
-    X = cells['Y'].tolist()
-    Z = cells['Z'].tolist()
-    #ID = cells['ID'].tolist()
-
-    #If orientation was flipped during processing in ClearMap (e.g. slicing 
-    # orientation=(1,-2,3) vs orientation=(1,2,3)) then reverse the order of that axis such as:
-    #X = X[::-1]
-    
-    #data is in voxels, so multiply by atlas resolution (25micronXYZ)
-    AtlasRes = 25
-    X = [element * AtlasRes for element in X]
-    Y = [element * AtlasRes for element in Y]
-    Z = [element * AtlasRes for element in Z]
-    pts = [[x, y, z] for x, y, z in zip(X, Y, Z)]
-    return np.vstack(pts)
+#Include cells in child regions of the regions/acronyms above (e.g. "MOs" also includes "MOs5")
+include_children = True
+hierarchy = load_hierarchy(brainrender.settings.DEFAULT_ATLAS)
+
+#Brain regions to add to the scene - IDs or acronyms
+brain_regions = ["CP", "STR"]
+
 
 
 # use clearmap importer function to read in cell coordinates
-coordinates1 = read_in_ClearMap_cells(cellsfile1, regions, acronyms)
-coordinates2 = read_in_ClearMap_cells(cellsfile2, regions, acronyms)
+coordinates1 = read_in_ClearMap_cells(cellsfile1, regions, acronyms, hierarchy=hierarchy if include_children else None)
+coordinates2 = read_in_ClearMap_cells(cellsfile2, regions, acronyms, hierarchy=hierarchy if include_children else None)
 
 #Create the scene
 
-scene = Scene(title="Cells from ClearMap")
+#region meshes are loaded from a precomputed bundle for the atlas (created the first time it is used)
+#mesh level: 0 = full atlas meshes, 1 and 2 = decimated to 50% and 20% of the faces (faster to render)
+mesh_level = 0
+bundle = load_mesh_bundle(brainrender.settings.DEFAULT_ATLAS)
+scene = make_scene(bundle, level=mesh_level, title="Cells from ClearMap")
 
 # Setting a screenshot save directory
 #scene = Scene(title="Cells", screenshots_folder="C:\\Users\\Luke_H\\Documents\\GitHub") 
@@ -93,27 +72,34 @@ scene = Scene(title="Cells from ClearMap")
 
 
 #Add in brain regions
-scene.add_brain_region("CP", alpha=0.35)
-scene.add_brain_region("STR", alpha=0.35)
+for region in region_acronyms(hierarchy, brain_regions):
+    add_region(scene, bundle, region, alpha=0.35)
 
 
 # Add points to scence
 
-scene.add(Points(coordinates1, name="CELLS", colors="magenta", alpha=0.2))
-scene.add(Points(coordinates2, name="CELLS", colors="springgreen", alpha=0.2))
+# large cell sets (>100k) are decimated and drawn as flat points, with more cells shown when zooming in
+add_cells(scene, coordinates1, name="CELLS", colors="magenta", alpha=0.2)
+add_cells(scene, coordinates2, name="CELLS", colors="springgreen", alpha=0.2)
 
 
 #Add density to scene - using modified method to allow different colors for densities
+#density of both cell sets computed together on the 25um atlas grid (number of cells within radius)
+#volumes are cached on disk, so rerunning with only colour/camera changes skips the computation
+density1, density2 = cached_density_volumes([coordinates1, coordinates2], radius=500, voxel_size=25,
+                                            atlas=brainrender.settings.DEFAULT_ATLAS)
 
-Density1 = Volume(PointsDensity(coordinates1, radius=500).color('Purples'),
+Density1 = Volume(density1,
                   voxel_size=25,
                   as_surface=False,
+                  cmap='Purples',
                   )
 
 
-Density2 = Volume(PointsDensity(coordinates2, radius=500).color('Greens'),
+Density2 = Volume(density2,
                   voxel_size=25,
                   as_surface=False,
+                  cmap='Greens',
                   )
 
 
@@ -141,6 +127,10 @@ vm = VideoMaker(scene, "./Movies", "Movie1")
 # e.g. 1 = 1 degree per frame
 vm.make_video(duration=3, azimuth=5, fps=15)
 
+#For long/high resolution movies - render offscreen in parallel with CI_Video.make_video
+#(move the scene setup above into a build_scene() function that returns the scene, see CI_Video.py)
+#make_video(build_scene, "./Movies/Movie1.mp4", duration=20, azimuth=5, fps=30, size=(3840, 2160))
+
 #Alternatively - render with key frames
 #anim = Animation(scene, "./examples", "vid3")
 
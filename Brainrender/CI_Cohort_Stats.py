@@ -0,0 +1,119 @@
+# region statistics for a cohort of brains, in parallel, with per-region group comparisons
+
+# Author: 	Luke Hammond
+# Cellular Imaging | Zuckerman Institute, Columbia University
+# Date:	18th October, 2026
+
+# Usage:
+#   python CI_Cohort_Stats.py cohort.csv --output haloperidol_vs_saline --processes 8
+#
+# cohort.csv lists one brain per row:
+#   brain,group,cells,layout
+#   1267,haloperidol,/home/luke/Desktop/haloperidol/1267/cells.csv,ClearMap
+#   1272,saline,/home/luke/Desktop/Saline/1272/cells.csv,ClearMap
+# cells can be csv or parquet files (CellMap CI_Cell_Export.py).
+#
+# Writes:
+#   <output>_regions.parquet - long table: brain, group, id, acronym, count, count_self, volume_mm3, density
+#   <output>_tests.csv       - per region: group means, t-test and Mann-Whitney p values for count and
+#                              density with Benjamini-Hochberg FDR correction (q values)
+# Each brain is summarized in its own worker process (CI_Region_Stats.summarize_cells).
+
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+import pandas as pd
+
+from CI_Region_Stats import read_stats_table, summarize_cells
+from CI_Regions import load_hierarchy, load_region_volumes
+
+#atlas tables of this worker process
+_atlas = {}
+
+
+def init_worker(hierarchy, volumes):
+    _atlas.update(hierarchy=hierarchy, volumes=volumes)
+
+
+def summarize_brain(brain):
+    #worker: region statistics of one brain - returns (brain, table or error)
+    try:
+        cells = read_stats_table(brain["cells"], brain.get("layout", "ClearMap"))
+        stats = summarize_cells(cells["ID"].to_numpy(), _atlas["hierarchy"], _atlas["volumes"])
+        stats.insert(0, "group", str(brain["group"]))
+        stats.insert(0, "brain", str(brain["brain"]))
+        return brain["brain"], stats, None
+    except Exception as error:
+        return brain["brain"], None, f"{type(error).__name__}: {error}"
+
+
+def cohort_statistics(brains, hierarchy, volumes, processes=None):
+    #long format table of region statistics for all brains (list of dictionaries from the cohort csv)
+    tables = []
+    with multiprocessing.get_context("spawn").Pool(processes, initializer=init_worker,
+                                                   initargs=(hierarchy, volumes)) as pool:
+        for i, (name, stats, error) in enumerate(pool.imap_unordered(summarize_brain, brains), 1):
+            if error is None:
+                print(f"{i}/{len(brains)} {name}: {stats['count_self'].sum()} cells")
+                tables.append(stats)
+            else:
+                print(f"{i}/{len(brains)} {name}: failed - {error}")
+    return pd.concat(tables, ignore_index=True)
+
+
+def fdr_correction(p_values):
+    #Benjamini-Hochberg q values, NaN p values are ignored
+    p_values = np.asarray(p_values, dtype=np.float64)
+    q_values = np.full(p_values.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p_values))
+    if len(valid) == 0:
+        return q_values
+    order = valid[np.argsort(p_values[valid])]
+    ranked = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    q_values[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return q_values
+
+
+def group_tests(table, group1, group2, measures=("count", "density")):
+    #per-region t-test and Mann-Whitney test between two groups, vectorized over regions
+    from scipy import stats
+
+    tests = table[["id", "acronym"]].drop_duplicates("id").set_index("id")
+    for measure in measures:
+        if measure not in table:
+            continue
+        values = table.pivot_table(index="id", columns=["group", "brain"], values=measure)
+        a = values[group1].reindex(tests.index).to_numpy()
+        b = values[group2].reindex(tests.index).to_numpy()
+        tests[f"{measure}_{group1}_mean"] = np.nanmean(a, axis=1)
+        tests[f"{measure}_{group2}_mean"] = np.nanmean(b, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tests[f"{measure}_t"], tests[f"{measure}_p_ttest"] = stats.ttest_ind(a, b, axis=1)
+            tests[f"{measure}_p_mannwhitney"] = stats.mannwhitneyu(a, b, axis=1).pvalue
+        tests[f"{measure}_q_ttest"] = fdr_correction(tests[f"{measure}_p_ttest"])
+        tests[f"{measure}_q_mannwhitney"] = fdr_correction(tests[f"{measure}_p_mannwhitney"])
+    return tests.reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Region statistics and group tests for a cohort of brains")
+    parser.add_argument("cohort", help="csv with columns brain, group, cells, layout")
+    parser.add_argument("--output", required=True, help="output prefix")
+    parser.add_argument("--atlas", default="allen_mouse_25um")
+    parser.add_argument("--groups", nargs=2, default=None, help="groups to compare (default: the two groups in the cohort)")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.time()
+    brains = pd.read_csv(args.cohort).to_dict("records")
+    hierarchy = load_hierarchy(args.atlas)
+    table = cohort_statistics(brains, hierarchy, load_region_volumes(args.atlas, hierarchy), args.processes)
+    table.to_parquet(args.output + "_regions.parquet", index=False)
+
+    groups = args.groups or list(pd.unique(table["group"]))
+    if len(groups) != 2:
+        raise SystemExit(f"Found groups {groups} - use --groups to choose the two groups to compare")
+    group_tests(table, *groups).to_csv(args.output + "_tests.csv", index=False)
+    print(f"Done in {time.time() - start:.0f}s - saved {args.output}_regions.parquet and {args.output}_tests.csv")
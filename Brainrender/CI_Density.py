@@ -0,0 +1,172 @@
+# fast cell density volumes for the brainrender scripts (replaces PointsDensity for large cell sets)
+
+# Author: 	Luke Hammond
+# Cellular Imaging | Zuckerman Institute, Columbia University
+# Date:	18th October, 2026
+
+# Usage:
+#   from CI_Density import density_volumes
+#   density1, density2 = density_volumes([coordinates1, coordinates2], radius=500, voxel_size=25)
+#   Density1 = Volume(density1, voxel_size=25, as_surface=False, cmap="Purples")
+#
+# Cells (atlas microns) are counted into the atlas voxel grid with a single np.bincount for all
+# channels, then smoothed with the kernel:
+#   "sphere"   - number of cells within radius of each voxel (as PointsDensity), FFT convolution
+#   "gaussian" - separable gaussian with sigma = radius / 2, normalised to the same total as "sphere"
+# Only the bounding box of the cells (plus the kernel radius) is convolved. Voxel (i,j,k) of the
+# returned float32 volumes is centred at (i,j,k) * voxel_size, as expected by brainrender Volume.
+#
+# cached_density_volumes stores the volumes on disk (~/.ci_brainrender/density) keyed by a hash of the
+# coordinates and the density settings, so rerunning a script with only colours or camera changes
+# loads them (memory mapped) instead of recomputing. The least recently used volumes are removed
+# when the cache grows beyond max_cache_size bytes.
+
+import hashlib
+import os
+
+import numpy as np
+
+from CI_Regions import CACHE_DIR
+
+DENSITY_CACHE_DIR = os.path.join(CACHE_DIR, "density")
+#maximum total size of cached density volumes (bytes)
+MAX_CACHE_SIZE = 10 * 1024 ** 3
+
+
+def grid_shape(point_sets, voxel_size=25, pad=0):
+    #smallest grid starting at the origin that contains all points, plus pad voxels
+    top = np.zeros(3)
+    for points in point_sets:
+        if len(points) > 0:
+            top = np.maximum(top, np.asarray(points).max(axis=0))
+    return tuple(int(n) for n in np.rint(top / voxel_size).astype(int) + 1 + pad)
+
+
+def bin_points(point_sets, voxel_size=25, shape=None):
+    #count points per voxel for several channels in one bincount - returns (channels, *shape) float32
+    if shape is None:
+        shape = grid_shape(point_sets, voxel_size)
+    n_voxels = int(np.prod(shape))
+    flat = []
+    for channel, points in enumerate(point_sets):
+        index = np.rint(np.asarray(points, dtype=np.float32) / np.float32(voxel_size)).astype(np.int64)
+        inside = np.all((index >= 0) & (index < np.array(shape)), axis=1)
+        flat.append(channel * n_voxels + np.ravel_multi_index(index[inside].T, shape))
+    counts = np.bincount(np.concatenate(flat) if flat else np.zeros(0, np.int64), minlength=len(point_sets) * n_voxels)
+    return counts.astype(np.float32).reshape((len(point_sets),) + tuple(shape))
+
+
+def sphere_kernel(radius_voxels):
+    r = int(np.ceil(radius_voxels))
+    x, y, z = np.ogrid[-r:r + 1, -r:r + 1, -r:r + 1]
+    return (x * x + y * y + z * z <= radius_voxels ** 2).astype(np.float32)
+
+
+def occupied_box(counts, pad):
+    #slices of the bounding box of non-empty voxels over all channels, padded by the kernel radius
+    occupied = counts.any(axis=0)
+    box = []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        index = np.flatnonzero(occupied.any(axis=other))
+        box.append(slice(max(index[0] - pad, 0), min(index[-1] + pad + 1, occupied.shape[axis])))
+    return tuple(box)
+
+
+def smooth_sphere(counts, radius_voxels):
+    #FFT convolution of each channel with a ball - the kernel transform is computed once
+    from scipy import fft
+
+    kernel = sphere_kernel(radius_voxels)
+    r = kernel.shape[0] // 2
+    shape = [fft.next_fast_len(n + 2 * r, real=True) for n in counts.shape[1:]]
+    kernel_fft = fft.rfftn(kernel, shape, workers=-1)
+    out = np.empty_like(counts)
+    for channel in range(len(counts)):
+        full = fft.irfftn(fft.rfftn(counts[channel], shape, workers=-1) * kernel_fft, shape, workers=-1)
+        out[channel] = full[r:r + counts.shape[1], r:r + counts.shape[2], r:r + counts.shape[3]]
+    #remove FFT round off in empty regions
+    np.maximum(out, 0, out=out)
+    return out
+
+
+def smooth_gaussian(counts, radius_voxels):
+    from scipy import ndimage
+
+    #scale so the integral matches the sphere kernel (cells within radius)
+    scale = np.float32(4 / 3 * np.pi * radius_voxels ** 3)
+    out = np.empty_like(counts)
+    for channel in range(len(counts)):
+        ndimage.gaussian_filter(counts[channel], sigma=radius_voxels / 2, output=out[channel], mode="constant")
+    return out * scale
+
+
+def density_volumes(point_sets, radius=500, voxel_size=25, shape=None, kernel="sphere"):
+    #density volumes (float32) for a list of point arrays (atlas microns), all on the same grid
+    radius_voxels = radius / voxel_size
+    pad = int(np.ceil(radius_voxels))
+    if shape is None:
+        shape = grid_shape(point_sets, voxel_size, pad)
+    counts = bin_points(point_sets, voxel_size, shape)
+    volumes = np.zeros_like(counts)
+    if not counts.any():
+        return list(volumes)
+
+    box = (slice(None),) + occupied_box(counts, pad)
+    if kernel == "sphere":
+        volumes[box] = smooth_sphere(counts[box], radius_voxels)
+    elif kernel == "gaussian":
+        volumes[box] = smooth_gaussian(counts[box], radius_voxels)
+    else:
+        raise ValueError(f"Unknown density kernel '{kernel}', expected 'sphere' or 'gaussian'")
+    return list(volumes)
+
+
+def density_volume(points, radius=500, voxel_size=25, shape=None, kernel="sphere"):
+    #density volume (float32) for a single point array
+    return density_volumes([points], radius, voxel_size, shape, kernel)[0]
+
+
+#%% Density cache
+
+def density_key(point_sets, **settings):
+    #hash of the coordinate arrays and all settings that affect the volumes
+    digest = hashlib.blake2b(digest_size=20)
+    for points in point_sets:
+        points = np.ascontiguousarray(points, dtype=np.float32)
+        digest.update(str(points.shape).encode())
+        digest.update(points.data)
+    digest.update(repr(sorted(settings.items())).encode())
+    return digest.hexdigest()
+
+
+def evict_density_cache(cache_dir, max_cache_size):
+    #remove least recently used volumes until the cache fits in max_cache_size bytes
+    files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith(".npy")]
+    files = sorted((os.stat(f).st_mtime, os.stat(f).st_size, f) for f in files)
+    total = sum(size for _, size, _ in files)
+    for _, size, f in files:
+        if total <= max_cache_size:
+            break
+        os.remove(f)
+        total -= size
+
+
+def cached_density_volumes(point_sets, radius=500, voxel_size=25, shape=None, kernel="sphere",
+                           atlas=None, cache_dir=DENSITY_CACHE_DIR, max_cache_size=MAX_CACHE_SIZE):
+    #density_volumes with a disk cache - atlas (e.g. brainrender.settings.DEFAULT_ATLAS) is part of the key
+    key = density_key(point_sets, radius=radius, voxel_size=voxel_size, shape=shape, kernel=kernel, atlas=atlas)
+    path = os.path.join(cache_dir, key + ".npy")
+    if os.path.exists(path):
+        #mark as recently used
+        os.utime(path)
+        return list(np.load(path, mmap_mode="r"))
+
+    volumes = density_volumes(point_sets, radius, voxel_size, shape, kernel)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, np.stack(volumes))
+    os.replace(tmp, path)
+    evict_density_cache(cache_dir, max_cache_size)
+    return volumes
@@ -0,0 +1,162 @@
+# precomputed atlas region mesh bundle for fast brainrender scene startup
+
+# Author: 	Luke Hammond
+# Cellular Imaging | Zuckerman Institute, Columbia University
+# Date:	18th October, 2026
+
+# Usage:
+#   bundle = load_mesh_bundle("allen_mouse_25um")
+#   scene = make_scene(bundle, level=0, title="Cells from BrainJ")   # instead of Scene(title=...)
+#   add_region(scene, bundle, "MOs", alpha=0.35)                      # instead of scene.add_brain_region("MOs", alpha=0.35)
+#
+# The first time an atlas is used, all region meshes are read from the atlas OBJ files, decimated to
+# each level in DECIMATION (fraction of faces kept) and written to one bundle per atlas in
+# ~/.ci_brainrender/meshes/<atlas> - vertices.npy and faces.npy for all meshes plus index.json with the
+# offsets and colours. Later scenes memory map the bundle and build each mesh from its slices.
+# The scene from make_scene takes the root mesh and any region added with scene.add_brain_region from the
+# bundle as well, at the scene's level (0 = full meshes, 1 and 2 = decimated, for faster rendering).
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from CI_Regions import CACHE_DIR
+
+MESH_CACHE_DIR = os.path.join(CACHE_DIR, "meshes")
+#fraction of faces kept at each level - level 0 is the full atlas mesh
+DECIMATION = (1.0, 0.5, 0.2)
+
+
+def mesh_arrays(mesh):
+    #vertices and triangle faces of a vedo mesh (older vedo: points()/faces(), newer: vertices/cells)
+    vertices = mesh.vertices if hasattr(mesh, "vertices") else mesh.points()
+    faces = mesh.cells if hasattr(mesh, "cells") else mesh.faces()
+    return np.asarray(vertices, dtype=np.float32), np.asarray(faces, dtype=np.int32).reshape(-1, 3)
+
+
+def build_mesh_bundle(atlas_name, path, decimation=DECIMATION):
+    #read, decimate and write all region meshes of an atlas (requires bg_atlasapi and vedo)
+    from bg_atlasapi import BrainGlobeAtlas
+    from vedo import Mesh
+
+    atlas = BrainGlobeAtlas(atlas_name)
+    vertices, faces, index = [], [], {}
+    n_vertices = n_faces = 0
+    for structure in atlas.structures_list:
+        acronym = structure["acronym"]
+        try:
+            filename = atlas.meshfile_from_structure(acronym)
+        except Exception:
+            continue
+        if not os.path.exists(filename):
+            continue
+        full = Mesh(str(filename)).triangulate()
+        levels = []
+        for fraction in decimation:
+            mesh = full if fraction >= 1 else full.clone().decimate(fraction=fraction)
+            v, f = mesh_arrays(mesh)
+            levels.append([n_vertices, n_vertices + len(v), n_faces, n_faces + len(f)])
+            vertices.append(v)
+            faces.append(f)
+            n_vertices += len(v)
+            n_faces += len(f)
+        index[acronym] = dict(levels=levels, color=[c / 255 for c in structure["rgb_triplet"]])
+
+    #written to a temporary folder and moved into place, so processes building the same bundle at the
+    #same time never see a partly written bundle
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + ".tmp", dir=os.path.dirname(path))
+    np.save(os.path.join(tmp, "vertices.npy"), np.concatenate(vertices))
+    np.save(os.path.join(tmp, "faces.npy"), np.concatenate(faces))
+    #written last - a bundle without it is incomplete and gets rebuilt
+    with open(os.path.join(tmp, "index.json"), "w") as f:
+        json.dump(dict(atlas=atlas_name, decimation=list(decimation), meshes=index), f)
+    if bundle_valid(path, decimation):
+        #another process finished first
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not bundle_valid(path, decimation):
+            raise
+
+
+def bundle_valid(path, decimation=DECIMATION):
+    #True if path holds a complete bundle built with these decimation levels
+    try:
+        with open(os.path.join(path, "index.json")) as f:
+            return json.load(f)["decimation"] == list(decimation)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def load_mesh_bundle(atlas_name, cache_dir=MESH_CACHE_DIR, decimation=DECIMATION):
+    #memory map the mesh bundle of an atlas, building it first if needed
+    path = os.path.join(cache_dir, atlas_name)
+    if not bundle_valid(path, decimation):
+        build_mesh_bundle(atlas_name, path, decimation)
+    with open(os.path.join(path, "index.json")) as f:
+        index = json.load(f)
+    index["vertices"] = np.load(os.path.join(path, "vertices.npy"), mmap_mode="r")
+    index["faces"] = np.load(os.path.join(path, "faces.npy"), mmap_mode="r")
+    return index
+
+
+def region_mesh(bundle, acronym, level=0):
+    #vedo mesh of a region from the bundle, coloured as in the atlas
+    from vedo import Mesh
+
+    try:
+        v0, v1, f0, f1 = bundle["meshes"][acronym]["levels"][level]
+    except KeyError:
+        raise ValueError(f"No mesh for region '{acronym}' in the {bundle['atlas']} mesh bundle")
+    mesh = Mesh([np.array(bundle["vertices"][v0:v1]), np.array(bundle["faces"][f0:f1])])
+    return mesh.c(bundle["meshes"][acronym]["color"])
+
+
+def add_region(scene, bundle, acronym, alpha=1, color=None, level=None):
+    #add a region mesh from the bundle to a brainrender scene (as scene.add_brain_region),
+    #at the level of the scene from make_scene unless given
+    if level is None:
+        level = getattr(scene, "mesh_level", 0)
+    mesh = region_mesh(bundle, acronym, level).alpha(alpha)
+    if color is not None:
+        mesh.c(color)
+    return scene.add(mesh, names=acronym, classes="brain region")
+
+
+def make_scene(bundle, level=0, **kwargs):
+    #brainrender Scene taking region meshes from the bundle at the given level - including the root mesh,
+    #which Scene.__init__ always adds (also with root=False), so no atlas OBJ file is read for it
+    from brainrender import Scene, settings
+
+    class BundleScene(Scene):
+        def __init__(self, bundle, level, **kwargs):
+            #set before Scene.__init__, which adds the root mesh
+            self.bundle, self.mesh_level = bundle, level
+            Scene.__init__(self, **kwargs)
+
+        def add_brain_region(self, *regions, alpha=1, color=None, silhouette=None, hemisphere="both", force=False):
+            #regions missing from the bundle and single hemispheres are left to brainrender
+            if hemisphere != "both" or any(region not in self.bundle["meshes"] for region in regions):
+                return Scene.add_brain_region(self, *regions, alpha=alpha, color=color, silhouette=silhouette,
+                                              hemisphere=hemisphere, force=force)
+            if not force:
+                already_in = [actor.name for actor in self.get_actors(br_class="brain region")]
+                regions = [region for region in regions if region not in already_in]
+            if not regions:
+                return None
+            actors = [add_region(self, self.bundle, region, alpha=alpha, color=color) for region in regions]
+            if silhouette is None:
+                silhouette = settings.SHADER_STYLE == "cartoon"
+            if silhouette and alpha:
+                self.add_silhouette(*actors, lw=2)
+            return actors[0] if len(actors) == 1 else actors
+
+    return BundleScene(bundle, level, **kwargs)
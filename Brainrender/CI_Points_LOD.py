@@ -0,0 +1,142 @@
+# level-of-detail rendering of large cell sets for the brainrender scripts
+
+# Author: 	Luke Hammond
+# Cellular Imaging | Zuckerman Institute, Columbia University
+# Date:	18th October, 2026
+
+# Usage:
+#   from CI_Points_LOD import add_cells
+#   add_cells(scene, coordinates1, name="Cells", colors="steelblue")
+#
+# Small cell sets are added as brainrender Points (one sphere per cell), as before.
+# Above sphere_limit cells, the points are sorted along a linear octree (Morton/Z-order curve) and
+# every n-th point along the curve is kept to fit the point budget - this keeps the local cell
+# density and spreads the sample evenly through the brain. The sample is drawn as flat points
+# (one pixel sprite per cell) instead of spheres. With zoom_levels=True, finer levels are
+# swapped in as the camera zooms in, up to all cells.
+
+import numpy as np
+
+#default number of points drawn for the whole brain view
+POINT_BUDGET = 1_000_000
+#above this number of cells, draw flat points instead of spheres
+SPHERE_LIMIT = 100_000
+
+
+def morton_codes(points, depth=16):
+    #Z-order (Morton) code of each point on a 2^depth grid over the bounding box of the points
+    points = np.asarray(points, dtype=np.float64)
+    low = points.min(axis=0)
+    extent = np.maximum(points.max(axis=0) - low, 1e-9)
+    grid = ((points - low) / extent * ((1 << depth) - 1)).astype(np.uint64)
+    codes = np.zeros(len(points), dtype=np.uint64)
+    for axis in range(3):
+        x = grid[:, axis]
+        #spread the bits of x so there are two zero bits between each of them
+        x = (x | (x << np.uint64(32))) & np.uint64(0x1F00000000FFFF)
+        x = (x | (x << np.uint64(16))) & np.uint64(0x1F0000FF0000FF)
+        x = (x | (x << np.uint64(8))) & np.uint64(0x100F00F00F00F00F)
+        x = (x | (x << np.uint64(4))) & np.uint64(0x10C30C30C30C30C3)
+        x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+        codes |= x << np.uint64(axis)
+    return codes
+
+
+def octree_order(points, depth=16):
+    #indices of the points sorted along the octree (Z-order curve)
+    return np.argsort(morton_codes(points, depth), kind="stable")
+
+
+def decimate(points, budget, order=None):
+    #density preserving subsample of at most budget points - every n-th point along the octree order
+    points = np.asarray(points)
+    if len(points) <= budget:
+        return points
+    if order is None:
+        order = octree_order(points)
+    step = int(np.ceil(len(points) / budget))
+    return points[np.sort(order[::step])]
+
+
+def lod_levels(points, budget=POINT_BUDGET, n_levels=3, order=None):
+    #list of decimated point sets from coarse (budget points) to fine, 4x more points per level
+    #(stops early once a level contains all points)
+    if order is None and len(points) > budget:
+        order = octree_order(points)
+    levels = []
+    for level in range(n_levels):
+        levels.append(decimate(points, budget * 4 ** level, order))
+        if len(levels[-1]) == len(points):
+            break
+    return levels
+
+
+def flat_points(points, colors="steelblue", alpha=1, point_size=2):
+    #vedo points drawn as flat sprites (no sphere glyphs)
+    from vedo import Points as VedoPoints
+
+    return VedoPoints(points, r=point_size, c=colors, alpha=alpha)
+
+
+def add_cells(scene, points, name="Cells", colors="steelblue", alpha=1, radius=20,
+              sphere_limit=SPHERE_LIMIT, budget=POINT_BUDGET, point_size=2, zoom_levels=True, n_levels=3):
+    #add cells to a brainrender scene - spheres for small sets, decimated flat points for large sets
+    if len(points) <= sphere_limit:
+        from brainrender.actors import Points
+
+        return scene.add(Points(points, name=name, colors=colors, alpha=alpha, radius=radius))
+
+    levels = lod_levels(points, budget, n_levels if zoom_levels else 1)
+    meshes = [flat_points(level, colors, alpha, point_size) for level in levels]
+    actors = [scene.add(mesh, names=name, classes="Points") for mesh in meshes]
+    if len(actors) > 1:
+        add_zoom_switch(scene, actors)
+    return actors[0]
+
+
+def show_level(actors, level):
+    for i, actor in enumerate(actors):
+        #brainrender draws a transformed clone of the mesh (actor._mesh) once the scene is rendered
+        for mesh in (actor.__dict__.get("_mesh"), actor.mesh):
+            if mesh is not None:
+                #newer vedo versions wrap the vtk actor, older ones are the vtk actor
+                getattr(mesh, "actor", mesh).SetVisibility(i == level)
+
+
+def zoom_switch(actors):
+    #StartEvent observer showing the level matching the camera zoom (distance to the focal point):
+    #each 2x zoom in shows the next level (4x more points, as the view covers 1/4 of the area)
+    state = dict(level=None, distance=None)
+
+    def switch(renderer, event):
+        distance = renderer.GetActiveCamera().GetDistance()
+        if state["distance"] is None:
+            state["distance"] = distance
+        zoom = state["distance"] / max(distance, 1e-9)
+        level = int(np.clip(np.floor(np.log2(max(zoom, 1e-9))), 0, len(actors) - 1))
+        if level != state["level"]:
+            show_level(actors, level)
+            state["level"] = level
+
+    return switch
+
+
+def add_zoom_switch(scene, actors):
+    #the drawn meshes only exist once the scene is rendered, so scene.render is wrapped: the first call
+    #renders without interaction to prepare the actors, then the switches are registered on the
+    #renderer and the scene is rendered as asked
+    if not hasattr(scene, "zoom_switches"):
+        scene.zoom_switches = []
+        render = scene.render
+
+        def render_with_switches(*args, **kwargs):
+            if scene.zoom_switches:
+                render(interactive=False, camera=kwargs.get("camera"), zoom=1)
+                for switch_actors in scene.zoom_switches:
+                    show_level(switch_actors, 0)
+                    scene.plotter.renderer.AddObserver("StartEvent", zoom_switch(switch_actors))
+                scene.zoom_switches = []
+            return render(*args, **kwargs)
+
+        scene.render = render_with_switches
+    scene.zoom_switches.append(actors)
@@ -0,0 +1,101 @@
+# per-region cell counts, densities and mean intensities from BrainJ or ClearMap cell tables
+
+# Author: 	Luke Hammond
+# Cellular Imaging | Zuckerman Institute, Columbia University
+# Date:	18th October, 2026
+
+# Usage:
+#   python CI_Region_Stats.py C1_Detected_Cells.csv --layout BrainJ --output C1_Region_Stats.csv
+#   python CI_Region_Stats.py cells.parquet --layout ClearMap --atlas allen_mouse_25um
+#
+# or from python:
+#   stats = region_statistics(cellsfile, "BrainJ", load_hierarchy("allen_mouse_25um"), volumes)
+#
+# For each atlas structure:
+#   count        - cells in the structure and all of its child regions
+#   count_self   - cells labelled with the structure itself
+#   volume_mm3   - annotation volume of the structure and its children
+#   density      - count / volume_mm3 (cells per mm3)
+#   mean_<name>  - mean intensity of the counted cells (BrainJ Mean_Int_Ch1..4 as mean_Ch1..4,
+#                  ClearMap source as mean_source)
+# Cells are counted with np.bincount on their position in the structure table, and the counts are
+# rolled up the hierarchy with one product with the descendant table (see CI_Regions.py).
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from CI_Cell_Loader import is_parquet
+from CI_Regions import atlas_index, load_hierarchy, load_region_volumes
+
+#positional columns of the region ID and intensities, in file order
+#columns - the same columns by name in parquet files
+STATS_LAYOUTS = {
+    "BrainJ": dict(usecols=[7, 8, 9, 10, 12], names=["Ch1", "Ch2", "Ch3", "Ch4", "ID"],
+                   columns=["Ch1", "Ch2", "Ch3", "Ch4", "ID"]),
+    "ClearMap": dict(usecols=[4, 9], names=["source", "ID"], columns=["source", "id"]),
+}
+
+
+def read_stats_table(filename, layout):
+    #read the region ID and intensity columns of a cell csv file (header row skipped)
+    #parquet files are read by column name
+    layout = STATS_LAYOUTS[layout]
+    dtypes = {name: np.float32 for name in layout["names"]}
+    dtypes["ID"] = np.int64
+    if is_parquet(filename):
+        cells = pd.read_parquet(filename, columns=layout["columns"])
+        return cells.rename(columns=dict(zip(layout["columns"], layout["names"]))).astype(dtypes)
+    return pd.read_csv(filename, usecols=layout["usecols"], names=layout["names"], dtype=dtypes,
+                       skiprows=[0], header=None, engine="c")
+
+
+def summarize_cells(ids, hierarchy, volumes=None, intensities=None):
+    #per-structure counts, densities and mean intensities for an array of cell region IDs
+    #intensities - optional dictionary of name: array (one value per cell)
+    n = len(hierarchy["ids"])
+    index = atlas_index(hierarchy, ids)
+    assigned = index >= 0
+    index = index[assigned]
+    #rolling up = sum over each structure's descendants
+    descendants = hierarchy["descendants"].astype(np.float64)
+
+    count_self = np.bincount(index, minlength=n)
+    count = descendants @ count_self
+    stats = pd.DataFrame(dict(id=hierarchy["ids"], acronym=hierarchy["acronyms"],
+                              count=count.astype(np.int64), count_self=count_self))
+    if volumes is not None:
+        stats["volume_mm3"] = descendants @ volumes
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stats["density"] = np.where(stats["volume_mm3"] > 0, count / stats["volume_mm3"], np.nan)
+    for name, values in (intensities or {}).items():
+        total = descendants @ np.bincount(index, weights=np.asarray(values, dtype=np.float64)[assigned], minlength=n)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stats[f"mean_{name}"] = np.where(count > 0, total / count, np.nan)
+    stats.attrs["unassigned"] = int((~assigned).sum())
+    return stats
+
+
+def region_statistics(filename, layout, hierarchy, volumes=None):
+    #read a cell csv file and summarize it per region
+    cells = read_stats_table(filename, layout)
+    intensities = {name: cells[name].to_numpy() for name in cells.columns if name != "ID"}
+    return summarize_cells(cells["ID"].to_numpy(), hierarchy, volumes, intensities)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-region cell counts, densities and intensities")
+    parser.add_argument("cells", help="BrainJ or ClearMap cell csv or parquet file")
+    parser.add_argument("--layout", choices=list(STATS_LAYOUTS), default="BrainJ")
+    parser.add_argument("--atlas", default="allen_mouse_25um")
+    parser.add_argument("--output", default=None, help="output csv (default: <cells>_region_stats.csv)")
+    args = parser.parse_args()
+
+    hierarchy = load_hierarchy(args.atlas)
+    stats = region_statistics(args.cells, args.layout, hierarchy, load_region_volumes(args.atlas, hierarchy))
+    output = args.output or os.path.splitext(args.cells)[0] + "_region_stats.csv"
+    stats.to_csv(output, index=False)
+    print(f"{stats['count_self'].sum()} cells in {(stats['count_self'] > 0).sum()} regions"
+          f" ({stats.attrs['unassigned']} outside the atlas) - saved {output}")
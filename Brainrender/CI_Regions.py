@@ -0,0 +1,133 @@
+# atlas hierarchy helpers for the brainrender scripts - region filtering including child regions
+
+# Author: 	Luke Hammond
+# Cellular Imaging | Zuckerman Institute, Columbia University
+# Date:	18th October, 2026
+
+# Usage:
+#   hierarchy = load_hierarchy("allen_mouse_25um")
+#   coordinates1 = read_in_BrainJ_cells(cellsfile, regions=[993], acronyms=[], hierarchy=hierarchy)  # MOs and all its layers
+#   for region in region_acronyms(hierarchy, ["MOs", 985]):
+#       scene.add_brain_region(region, alpha=0.35)
+#
+# The structure tree is converted once per atlas to a descendant table (boolean matrix, row = parent,
+# column = structure, True if the structure is the parent or one of its children) and cached on disk.
+# Filtering cells is then a single lookup of each cell ID into the selected columns.
+
+import os
+import tempfile
+
+import numpy as np
+
+#folder for files cached by the CI brainrender helpers
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".ci_brainrender")
+
+
+def build_hierarchy(atlas_name):
+    #build the descendant table from the atlas structure tree (requires bg_atlasapi, installed with brainrender)
+    from bg_atlasapi import BrainGlobeAtlas
+
+    structures = BrainGlobeAtlas(atlas_name).structures_list
+    ids = np.array(sorted(s["id"] for s in structures), dtype=np.int64)
+    acronyms = {s["id"]: s["acronym"] for s in structures}
+    descendants = np.zeros((len(ids), len(ids)), dtype=bool)
+    for s in structures:
+        #structure_id_path lists the root ... parent, structure
+        column = np.searchsorted(ids, s["id"])
+        descendants[np.searchsorted(ids, s["structure_id_path"]), column] = True
+    return dict(ids=ids, acronyms=np.array([acronyms[i] for i in ids], dtype=str), descendants=descendants)
+
+
+def load_hierarchy(atlas_name, cache_dir=CACHE_DIR):
+    #returns the (cached) descendant table for an atlas, e.g. "allen_mouse_25um"
+    path = os.path.join(cache_dir, f"{atlas_name}_hierarchy.npz")
+    if not os.path.exists(path):
+        hierarchy = build_hierarchy(atlas_name)
+        os.makedirs(cache_dir, exist_ok=True)
+        #written to a temporary file and moved into place, so other processes never load a partly written cache
+        handle, tmp = tempfile.mkstemp(prefix=os.path.basename(path), suffix=".npz", dir=cache_dir)
+        try:
+            with os.fdopen(handle, "wb") as f:
+                np.savez(f, **hierarchy)
+            os.replace(tmp, path)
+        except OSError:
+            #the cache is still open in another process (Windows) - keep the one it wrote
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            if not os.path.exists(path):
+                raise
+        return hierarchy
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def structure_index(hierarchy, regions):
+    #row/column in the descendant table for region IDs and/or acronyms
+    index = []
+    for region in regions:
+        if isinstance(region, str):
+            match = np.flatnonzero(hierarchy["acronyms"] == region)
+        else:
+            match = np.flatnonzero(hierarchy["ids"] == region)
+        if len(match) == 0:
+            raise ValueError(f"Region '{region}' not found in atlas structure tree")
+        index.append(match[0])
+    return np.array(index, dtype=np.int64)
+
+
+def select_structures(hierarchy, regions=(), acronyms=()):
+    #boolean mask over atlas structures - all children of the given regions (IDs) and acronyms
+    #as for the exact filters, cells must match both regions and acronyms if both are given
+    #returns None if nothing is selected (= keep all cells)
+    if len(regions) == 0 and len(acronyms) == 0:
+        return None
+    selected = np.ones(len(hierarchy["ids"]), dtype=bool)
+    if len(regions) > 0:
+        selected &= hierarchy["descendants"][structure_index(hierarchy, regions)].any(axis=0)
+    if len(acronyms) > 0:
+        selected &= hierarchy["descendants"][structure_index(hierarchy, acronyms)].any(axis=0)
+    return selected
+
+
+def atlas_index(hierarchy, ids):
+    #position of each ID in the structure table, -1 for IDs not in the atlas (e.g. 0, outside the brain)
+    ids = np.asarray(ids)
+    atlas_ids = hierarchy["ids"]
+    index = np.minimum(np.searchsorted(atlas_ids, ids), len(atlas_ids) - 1)
+    return np.where(atlas_ids[index] == ids, index, -1)
+
+
+def region_mask(hierarchy, ids, selected):
+    #True for each cell ID that is in the selected structures - one vectorized gather
+    #IDs not in the atlas (e.g. 0, outside the brain) are never selected
+    index = atlas_index(hierarchy, ids)
+    return selected[index] & (index >= 0)
+
+
+def region_voxel_counts(annotation, hierarchy, planes=64):
+    #number of annotation voxels labelled with each structure (not including children)
+    counts = np.zeros(len(hierarchy["ids"]), dtype=np.int64)
+    for z in range(0, annotation.shape[0], planes):
+        index = atlas_index(hierarchy, np.asarray(annotation[z:z + planes]).ravel())
+        counts += np.bincount(index[index >= 0], minlength=len(counts))
+    return counts
+
+
+def load_region_volumes(atlas_name, hierarchy, cache_dir=CACHE_DIR):
+    #volume of each structure in mm3 (not including children) from the atlas annotation - cached
+    path = os.path.join(cache_dir, f"{atlas_name}_volumes.npy")
+    if os.path.exists(path):
+        return np.load(path)
+    from bg_atlasapi import BrainGlobeAtlas
+
+    atlas = BrainGlobeAtlas(atlas_name)
+    voxel_mm3 = np.prod(np.asarray(atlas.resolution, dtype=np.float64) / 1000)
+    volumes = region_voxel_counts(atlas.annotation, hierarchy) * voxel_mm3
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(path, volumes)
+    return volumes
+
+
+def region_acronyms(hierarchy, regions):
+    #acronyms for a list of region IDs and/or acronyms - for scene.add_brain_region
+    return [str(acronym) for acronym in hierarchy["acronyms"][structure_index(hierarchy, regions)]]
@@ -0,0 +1,156 @@
+# parallel offscreen video rendering for brainrender scenes (rotations and keyframe animations)
+
+# Author: 	Luke Hammond
+# Cellular Imaging | Zuckerman Institute, Columbia University
+# Date:	18th October, 2026
+
+# Usage - the scene is built by a function, so each worker process can rebuild it once:
+#
+#   def build_scene():
+#       scene = Scene(title="Cells from ClearMap")
+#       ...
+#       return scene
+#
+#   if __name__ == "__main__":
+#       # same movement as vm.make_video(duration=20, azimuth=5, fps=30)
+#       make_video(build_scene, "./Movies/Movie1.mp4", duration=20, fps=30, azimuth=5, size=(3840, 2160))
+#       # or keyframes as with brainrender Animation: (time in seconds, camera, zoom)
+#       make_video(build_scene, "./Movies/Movie2.mp4", duration=3, fps=15,
+#                  keyframes=[(0, "top", 1.3), (1, "sagittal", 3), (2, "frontal", 0.8), (3, "frontal", 1)])
+#
+# The frame range is split into one block per worker. Each worker renders its frames offscreen and pipes
+# the raw pixels straight into ffmpeg, writing one encoded segment (no png per frame). The segments
+# are then joined without re-encoding. ffmpeg must be on the PATH.
+
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from rich import print
+from myterial import orange
+
+
+def rotate_camera(camera, azimuth=0, elevation=0, roll=0, steps=1):
+    #apply the per-frame rotation steps times (same order as brainrender VideoMaker)
+    for _ in range(steps):
+        camera.Azimuth(azimuth)
+        camera.Elevation(elevation)
+        camera.Roll(roll)
+        camera.OrthogonalizeViewUp()
+
+
+def keyframe_camera(keyframes, t):
+    #camera parameters and zoom at time t, linearly interpolated between keyframes
+    from brainrender.camera import get_camera
+
+    times = [k[0] for k in keyframes]
+    i = int(np.clip(np.searchsorted(times, t, side="right") - 1, 0, max(len(keyframes) - 2, 0)))
+    start, end = keyframes[i], keyframes[min(i + 1, len(keyframes) - 1)]
+    w = 0 if end[0] == start[0] else float(np.clip((t - start[0]) / (end[0] - start[0]), 0, 1))
+    #cameras can be brainrender camera names or camera dictionaries
+    cam0, cam1 = [get_camera(c) if isinstance(c, str) else c for c in (start[1], end[1])]
+    camera = {key: ((1 - w) * np.asarray(cam0[key]) + w * np.asarray(cam1[key])).tolist() for key in cam0 if key in cam1}
+    zoom = (1 - w) * start[2] + w * end[2]
+    return camera, zoom
+
+
+def grab_frame(window, grabber):
+    from vtk.util.numpy_support import vtk_to_numpy
+
+    window.Render()
+    grabber.Modified()
+    grabber.Update()
+    image = grabber.GetOutput()
+    width, height, _ = image.GetDimensions()
+    pixels = vtk_to_numpy(image.GetPointData().GetScalars()).reshape(height, width, -1)
+    #vtk images start at the bottom row
+    return np.ascontiguousarray(pixels[::-1, :, :3])
+
+
+def render_segment(task):
+    #worker: build the scene once, render frames [start, end) and encode them into one segment
+    import brainrender
+    import vtk
+    from brainrender.camera import set_camera
+
+    brainrender.settings.OFFSCREEN = True
+    scene = task["build_scene"]()
+    width, height = task["size"]
+    scene.render(interactive=False, camera=task["camera"], zoom=task["zoom"])
+    window = scene.plotter.window
+    window.SetOffScreenRendering(1)
+    window.SetSize(width, height)
+    camera = scene.plotter.camera
+    grabber = vtk.vtkWindowToImageFilter()
+    grabber.SetInput(window)
+    grabber.SetInputBufferTypeToRGB()
+    grabber.ReadFrontBufferOff()
+
+    encoder = subprocess.Popen(
+        ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}",
+         "-r", str(task["fps"]), "-i", "-", "-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", str(task["crf"]),
+         task["segment"]],
+        stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    keyframes = task["keyframes"]
+    if not keyframes:
+        #move to the first frame of this segment without rendering
+        rotate_camera(camera, *task["rotation"], steps=task["start"])
+    closed_early = False
+    try:
+        for frame in range(task["start"], task["end"]):
+            if keyframes:
+                params, zoom = keyframe_camera(keyframes, frame / task["fps"])
+                set_camera(scene, params)
+                camera.Zoom(zoom)
+            encoder.stdin.write(grab_frame(window, grabber).tobytes())
+            if not keyframes:
+                rotate_camera(camera, *task["rotation"])
+        encoder.stdin.close()
+    except BrokenPipeError:
+        #ffmpeg exited early - its own error is reported below
+        closed_early = True
+        try:
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass
+    encoder.wait()
+    error = encoder.stderr.read().decode(errors="replace").strip()
+    scene.close()
+    if encoder.returncode != 0 or closed_early:
+        raise RuntimeError(f"ffmpeg failed encoding frames {task['start']}-{task['end']} "
+                           f"(exit code {encoder.returncode}): {error}")
+    return task["segment"]
+
+
+def make_video(build_scene, output, duration=3, fps=15, azimuth=0, elevation=0, roll=0, keyframes=None,
+               camera=None, zoom=1, size=(1920, 1080), processes=None, crf=18):
+    #render a video in parallel - build_scene must be a module level function returning a brainrender Scene
+    n_frames = int(duration * fps)
+    processes = min(processes or os.cpu_count(), n_frames)
+    bounds = np.linspace(0, n_frames, processes + 1).astype(int)
+    folder = tempfile.mkdtemp(prefix="ci_video_")
+    tasks = [dict(build_scene=build_scene, start=int(start), end=int(end), fps=fps, size=size, camera=camera,
+                  zoom=zoom, rotation=(azimuth, elevation, roll), keyframes=keyframes, crf=crf,
+                  segment=os.path.join(folder, f"segment_{i:04d}.mp4"))
+             for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])) if end > start]
+
+    print(f"[{orange}]Rendering {n_frames} frames with {len(tasks)} processes")
+    start = time.time()
+    try:
+        #spawn - each worker creates its own VTK context
+        with multiprocessing.get_context("spawn").Pool(len(tasks)) as pool:
+            segments = pool.map(render_segment, tasks)
+        with open(os.path.join(folder, "segments.txt"), "w") as f:
+            f.writelines(f"file '{segment}'\n" for segment in segments)
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+                        "-i", os.path.join(folder, "segments.txt"), "-c", "copy", output], check=True)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    print(f"[{orange}]Saved {output} in {time.time() - start:.0f}s")
+    return output
@@ -0,0 +1,140 @@
+# memory-mapped loading of atlas-space image volumes for the brainrender volume script
+
+# Author: 	Luke Hammond
+# Cellular Imaging | Zuckerman Institute, Columbia University
+# Date:	18th October, 2026
+
+# Usage:
+#   from CI_Volumes import load_volume
+#   vol = load_volume(volfile, voxel_size=25, source_voxel_size=25, axes=(2, 1, 0))
+#   Vol_actor = Volume(vol, voxel_size=25, ...)
+#
+# TIFF (uncompressed), NPY and Zarr files are opened without reading them into memory, and the axis
+# reorder (e.g. swapping axes 0 and 2 for coronal BrainJ data) is a view. If the requested voxel_size is
+# coarser than the source, the volume is block averaged while reading, a few planes at a time, so
+# memory use stays near the size of the volume that is rendered rather than the raw file.
+#
+# For large/fine volumes (10um or finer), load_pyramid_volume builds 2x/4x/8x downsampled copies once
+# (<name>_pyramid folder next to the file, one memory-mappable .npy per level) and picks the level from
+# a voxel budget (max_voxels) or from the window size and zoom:
+#   vol, voxel_size = load_pyramid_volume(volfile, source_voxel_size=10, axes=(2, 1, 0), max_voxels=20_000_000)
+#   Vol_actor = Volume(vol, voxel_size=voxel_size, ...)
+
+import json
+import os
+
+import numpy as np
+
+
+def open_volume(filename):
+    #open a volume without loading it - returns a numpy memmap (tif/npy) or zarr array
+    extension = os.path.splitext(filename.rstrip("/\\"))[1].lower()
+    if extension == ".npy":
+        return np.load(filename, mmap_mode="r")
+    if extension == ".zarr":
+        import zarr
+
+        return zarr.open(filename, mode="r")
+    if extension in (".tif", ".tiff"):
+        import tifffile
+
+        try:
+            return tifffile.memmap(filename, mode="r")
+        except ValueError:
+            #compressed or non-contiguous tiff files can not be memory mapped - read them instead
+            return tifffile.imread(filename)
+    raise ValueError(f"Unsupported volume format '{extension}' for {filename}, expected .tif, .npy or .zarr")
+
+
+def downsample_factor(voxel_size, source_voxel_size):
+    factor = voxel_size / source_voxel_size
+    if factor < 1 or abs(factor - round(factor)) > 1e-6:
+        raise ValueError(f"voxel_size ({voxel_size}) must be a whole multiple of source_voxel_size ({source_voxel_size})")
+    return int(round(factor))
+
+
+def block_mean(source, factor, dtype=np.float32):
+    #block average of a (memory mapped) volume by an integer factor, reading factor planes at a time
+    shape = tuple(n // factor for n in source.shape)
+    out = np.empty(shape, dtype=dtype)
+    for i in range(shape[0]):
+        slab = np.asarray(source[i * factor:(i + 1) * factor, :shape[1] * factor, :shape[2] * factor], dtype=dtype)
+        out[i] = slab.reshape(factor, shape[1], factor, shape[2], factor).mean(axis=(0, 2, 4))
+    return out
+
+
+def load_volume(filename, voxel_size=25, source_voxel_size=25, axes=None):
+    #open a volume, downsample it to voxel_size if needed and reorder the axes (e.g. axes=(2, 1, 0))
+    source = open_volume(filename)
+    factor = downsample_factor(voxel_size, source_voxel_size)
+    if factor > 1:
+        source = block_mean(source, factor)
+    elif not isinstance(source, np.ndarray):
+        source = np.asarray(source)
+    if axes is not None:
+        source = np.transpose(source, axes)
+    return source
+
+
+#%% Multi-resolution pyramid
+
+PYRAMID_FACTORS = (2, 4, 8)
+
+
+def pyramid_path(filename):
+    root, _ = os.path.splitext(filename.rstrip("/\\"))
+    return root + "_pyramid"
+
+
+def build_pyramid(filename, factors=PYRAMID_FACTORS):
+    #write block averaged copies of a volume, each level computed from the previous one
+    #returns the folder containing level_<factor>.npy files and pyramid.json
+    path = pyramid_path(filename)
+    stat = os.stat(filename)
+    signature = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, factors=list(factors))
+    try:
+        with open(os.path.join(path, "pyramid.json")) as f:
+            if json.load(f) == signature:
+                return path
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(path, exist_ok=True)
+    level, previous = open_volume(filename), 1
+    for factor in factors:
+        level = block_mean(level, factor // previous)
+        np.save(os.path.join(path, f"level_{factor}.npy"), level)
+        level, previous = np.load(os.path.join(path, f"level_{factor}.npy"), mmap_mode="r"), factor
+    #written last - a pyramid without it is incomplete and gets rebuilt
+    with open(os.path.join(path, "pyramid.json"), "w") as f:
+        json.dump(signature, f)
+    return path
+
+
+def select_level(shape, factors=PYRAMID_FACTORS, max_voxels=None, window_size=None, zoom=1):
+    #downsampling factor (1 = source) for a volume shape:
+    # max_voxels - finest level with at most max_voxels voxels
+    # window_size - coarsest level that still has about one voxel per screen pixel across the brain
+    levels = (1,) + tuple(factors)
+    if max_voxels is not None:
+        for factor in levels:
+            if np.prod([n // factor for n in shape]) <= max_voxels:
+                return factor
+        return levels[-1]
+    if window_size is not None:
+        pixels = max(window_size) * zoom
+        fits = [factor for factor in levels if max(shape) / factor >= pixels]
+        return max(fits) if fits else 1
+    return 1
+
+
+def load_pyramid_volume(filename, source_voxel_size=25, axes=None, max_voxels=None, window_size=None, zoom=1,
+                        factors=PYRAMID_FACTORS):
+    #load the pyramid level chosen by select_level - returns the volume and its voxel size
+    shape = open_volume(filename).shape
+    factor = select_level(shape, factors, max_voxels, window_size, zoom)
+    if factor == 1:
+        return load_volume(filename, source_voxel_size, source_voxel_size, axes), source_voxel_size
+    path = build_pyramid(filename, factors)
+    voxel_size = source_voxel_size * factor
+    return load_volume(os.path.join(path, f"level_{factor}.npy"), voxel_size, voxel_size, axes), voxel_size
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized atlas annotation of cell coordinates - Cellular Imaging / Zuckerman Institute
+=======
+
+Replaces ano.label_points followed by one ano.convert_label call each for name, id and
+acronym, stored as 'U256' columns (about 1 KB per cell per string column).
+
+The atlas structures are converted once into dense lookup arrays indexed by the structure
+order (the label returned by ano.label_points with key='order'). Cells are labelled once and
+their ids are taken from the lookup with a single gather. Acronyms and names are not stored
+per cell: the order is their categorical code, and the region table (order, id, acronym,
+name) is written once next to the cells.
+
+Usage
+-----
+  import CI_Annotation as can
+  lookup = can.region_lookup()
+  order, ids = can.annotate_points(coordinates_transformed, lookup)
+  acronyms = can.expand(order, lookup, 'acronym')
+  can.write_region_table(ws.filename('cells', postfix='regions', extension='csv'), lookup)
+
+@author: Luke Hammond
+"""
+
+import numpy as np
+
+
+def region_lookup(values=('id', 'acronym', 'name')):
+  """Dense order -> value lookup arrays of the current ClearMap annotation (ano.set_annotation_file).
+
+  Returns
+  -------
+  lookup : dict
+    'order' and one array per value, with entry i holding the value of the structure with
+    order i. Orders not used by the atlas get id -1 and empty strings.
+  """
+  import ClearMap.Alignment.Annotation as ano
+
+  tables = dict((value, ano.get_dictionary(key='order', value=value)) for value in values)
+  n = max(max(t) for t in tables.values()) + 1
+  lookup = dict(order=np.arange(n, dtype=np.int32))
+  for value, table in tables.items():
+    if value == 'id':
+      array = np.full(n, -1, dtype=np.int32)
+    else:
+      array = np.full(n, '', dtype=object)
+    for order, v in table.items():
+      array[order] = v
+    lookup[value] = array
+  return lookup
+
+
+def annotate_points(coordinates, lookup, annotation_file=None):
+  """Structure order and id of each point, labelling the annotation volume once.
+
+  Arguments
+  ---------
+  coordinates : array (n, 3)
+    Point coordinates in atlas voxels, e.g. the transformed cell coordinates.
+  lookup : dict
+    The region lookup from region_lookup.
+  annotation_file : str or None
+    The annotation volume (None = the current ClearMap annotation file).
+
+  Returns
+  -------
+  order, ids : array
+    int32 structure order (the categorical code of acronym and name) and atlas id per point.
+  """
+  import ClearMap.Alignment.Annotation as ano
+
+  order = np.asarray(ano.label_points(coordinates, annotation_file=annotation_file, key='order'), dtype=np.int32)
+  return order, lookup['id'][order]
+
+
+def expand(order, lookup, value):
+  """Per point values (e.g. 'acronym' or 'name') from the structure orders with one gather."""
+  return lookup[value][order]
+
+
+def write_region_table(filename, lookup):
+  """Write the region table (order, id, acronym, name) of the used orders as csv, names quoted."""
+  import csv
+
+  values = [v for v in ('id', 'acronym', 'name') if v in lookup]
+  with open(filename, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(['order'] + values)
+    for order in np.flatnonzero(lookup['id'] >= 0) if 'id' in lookup else lookup['order']:
+      writer.writerow([order] + [lookup[v][order] for v in values])
+  return filename
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CellMap batch driver - Cellular Imaging / Zuckerman Institute
+=======
+
+Runs the CellMap pipeline (CI_CellMap_Stages.py) for a whole cohort on one machine, instead of
+editing the directory and expressions in CellMap_CI_V1.py and rerunning it for each brain.
+
+The stages of all brains are scheduled together by CI_Pipeline.run_concurrent within the core,
+memory and disk budget of the machine, using the resource profile of each stage (conversion is
+disk bound, elastix is cpu bound, detection needs memory for its processing blocks). Brains are
+interleaved - while one brain converts, others resample, align or detect - with the longest
+remaining work started first, using the stage durations recorded for earlier brains. Each brain
+keeps its own pipeline_state.json, so a rerun of the batch skips finished stages, and a failed
+stage only stops the later stages of that brain - also when its process is killed (e.g. out of
+memory during detection), as every stage runs in its own worker process.
+
+Usage
+-----
+  python CI_CellMap_Batch.py cohort.json
+
+cohort.json:
+  {
+    "clearmap": "/home/luke/Documents/Github/ClearMap2",
+    "cpus": 32, "memory": 120, "io": 1,
+    "slicing": [[null, null], [null, null], [0, 228]],
+    "orientation": [1, 2, 3],
+    "parameters": {"thresholds": {"size": [20, 900]}},
+    "brains": [
+      {"name": "1267", "directory": "/home/luke/Desktop/haloperidol/1267",
+       "raw": "cfos/14-22-33_0_8X-cfos_UltraII_C00_xyz-Table Z<Z,4>.ome.tif",
+       "autofluorescence": "autof/15-30-26_0_8X-autofluo_UltraII_C00_xyz-Table Z<Z,4>.ome.tif"},
+      {"name": "1272", "directory": "/home/luke/Desktop/Saline/1272", "raw": "...", "autofluorescence": "...",
+       "parameters": {"cell_detection": {"maxima_detection": {"threshold": 800}}}}
+    ]
+  }
+
+parameters (cohort wide) and the parameters of a brain override CI_CellMap_Stages.default_parameters().
+The status of every stage is written to <cohort>_status.json at the end.
+
+@author: Luke Hammond
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+
+def merge_parameters(parameters, overrides):
+  """Recursively update a parameter dictionary with the values of overrides."""
+  for key, value in (overrides or {}).items():
+    if isinstance(value, dict) and isinstance(parameters.get(key), dict):
+      merge_parameters(parameters[key], value)
+    else:
+      parameters[key] = value
+  return parameters
+
+
+class BatchProgress(object):
+  """Per brain progress of a batch, printed as stages are skipped, finished or failed."""
+
+  def __init__(self, stages):
+    self.total = {}
+    for stage in stages:
+      self.total[stage.group] = self.total.get(stage.group, 0) + 1
+    self.finished = dict((brain, 0) for brain in self.total)
+    self.failed = dict((brain, []) for brain in self.total)
+
+  def __call__(self, stage, message):
+    brain = stage.group
+    if message.startswith('running'):
+      print('[%s] %s %s' % (brain, stage.name, message))
+      return
+    self.finished[brain] += 1
+    if message.startswith('failed'):
+      self.failed[brain].append(stage.name)
+    print('[%s] %d/%d stages - %s %s' % (brain, self.finished[brain], self.total[brain], stage.name, message))
+
+
+def run_batch(cohort, verbose=True):
+  """Run the CellMap stages of all brains of a cohort (dictionary as in cohort.json).
+
+  Returns
+  -------
+  status : dict
+    Brain -> stage name -> status (see CI_Pipeline.run_concurrent).
+  """
+  if cohort.get('clearmap'):
+    sys.path.append(cohort['clearmap'])
+  import ClearMap.Alignment.Annotation as ano
+  import ClearMap.IO.Workspace as wsp
+
+  import CI_Pipeline as pipe
+  import CI_CellMap_Stages as cms
+
+  slicing = tuple(slice(*s) for s in cohort.get('slicing', [[None, None]] * 3))
+  annotation_file, reference_file, distance_file = ano.prepare_annotation_files(
+      slicing=slicing, orientation=tuple(cohort.get('orientation', (1,2,3))), overwrite=False, verbose=verbose)
+
+  stages, state_files = [], {}
+  for brain in cohort['brains']:
+    name = str(brain['name'])
+    if name in state_files:
+      raise ValueError('Brain %s is listed twice' % name)
+    ws = wsp.Workspace('CellMap', directory=brain['directory'])
+    ws.update(raw=brain['raw'], autofluorescence=brain['autofluorescence'])
+    parameters = merge_parameters(merge_parameters(cms.default_parameters(), cohort.get('parameters')),
+                                  brain.get('parameters'))
+    stages += cms.cellmap_stages(ws, annotation_file, reference_file, parameters, group=name)
+    state_files[name] = cms.state_file(ws)
+
+  progress = BatchProgress(stages)
+  start = time.time()
+  status = pipe.run_concurrent(stages, state_files, cpus=cohort.get('cpus'), memory=cohort.get('memory'),
+                               io=cohort.get('io', 1), raise_errors=False, progress=progress, verbose=False)
+
+  by_brain = dict((brain, {}) for brain in state_files)
+  for stage in stages:
+    by_brain[stage.group][stage.name] = status[stage.id]
+  if verbose:
+    print('Batch finished in %.0f min' % ((time.time() - start) / 60))
+    for brain, failed in progress.failed.items():
+      print('[%s] %s' % (brain, 'failed: ' + ', '.join(failed) if failed else 'complete'))
+  return by_brain
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Run the CellMap pipeline for a cohort of brains')
+  parser.add_argument('cohort', help='cohort json file')
+  args = parser.parse_args()
+
+  with open(args.cohort) as f:
+    cohort = json.load(f)
+  status = run_batch(cohort)
+  output = os.path.splitext(args.cohort)[0] + '_status.json'
+  with open(output, 'w') as f:
+    json.dump(status, f, indent=1)
+  print('Saved %s' % output)
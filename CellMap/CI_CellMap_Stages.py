@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CellMap pipeline stages - Cellular Imaging / Zuckerman Institute
+=======
+
+The steps of CellMap_CI_V1.py as a stage graph (see CI_Pipeline.py):
+
+  convert -> resample, resample_auto -> align_resampled_to_auto, align_auto_to_reference
+  -> detect -> filter -> transform -> annotate -> export, voxelize
+
+Each stage function runs one step with the parameters of the script, so a rerun after a crash
+or a parameter change (e.g. the filter thresholds) resumes from the first stage that changed.
+
+The stages carry the resource profiles in parameters['resources'], so pipe.run_concurrent can
+overlap independent stages: the two resamplings run together, and detection on the stitched
+volume runs alongside both elastix alignments.
+
+With parameters['stitched']['format'] = 'zarr' the stitched volume is a compressed Zarr array
+(CI_Zarr.py), resampled by CI_Resampling.py and searched for cells block by block.
+
+With parameters['resample_channels']['fused'] = True one resample_channels stage replaces
+resample and resample_auto - both channels are resampled in one pass (CI_Resampling.py), also
+to the extra sink_resolutions (e.g. (10,10,10) -> resampled_10um.tif).
+
+Usage
+-----
+  import CI_CellMap_Stages as cms
+  import CI_Pipeline as pipe
+  parameters = cms.default_parameters()
+  parameters['thresholds']['size'] = (20, 900)
+  stages = cms.cellmap_stages(ws, annotation_file, reference_file, parameters)
+  pipe.run_stages(stages, cms.state_file(ws))
+  pipe.run_concurrent(stages, cms.state_file(ws), cpus=32, memory=120)
+
+@author: Luke Hammond
+"""
+
+import copy
+import os
+
+import numpy as np
+
+from CI_Pipeline import Stage
+
+
+###############################################################################
+### Parameters
+###############################################################################
+
+def default_parameters():
+  """The parameters of CellMap_CI_V1.py - edit the returned dictionary before building the stages."""
+  import ClearMap.ImageProcessing.Experts.Cells as cells
+
+  cell_detection_parameter = copy.deepcopy(cells.default_cell_detection_parameter)
+  cell_detection_parameter['iullumination_correction']['flatfield'] = None
+  cell_detection_parameter['background_correction']['shape'] = (7,7)
+  cell_detection_parameter['background_correction']['form'] = 'Disk'
+  cell_detection_parameter['intensity_detection']['measure'] = ['source']
+  cell_detection_parameter['maxima_detection']['shape'] = 3
+  cell_detection_parameter['maxima_detection']['threshold'] = 700
+
+  processing_parameter = copy.deepcopy(cells.default_cell_detection_processing_parameter)
+  processing_parameter.update(processes = 6, size_max = 100, size_min = 50, overlap = 16, verbose = True)
+
+  return dict(
+      #stitched volume - 'npy' (io.convert) or 'zarr' (compressed chunks, see CI_Zarr.py)
+      stitched = dict(format = 'npy', chunks = (16,512,512), readers = 8, writers = 4, block_planes = 200),
+      resample = dict(source_resolution = (4.0625, 4.0625, 3), sink_resolution = (25,25,25),
+                      processes = 4, verbose = True),
+      resample_auto = dict(source_resolution = (4.0625, 4.0625, 3), sink_resolution = (25,25,25),
+                           processes = 4, verbose = True),
+      #resample stitched and autofluorescence in one pass, plus extra resolutions e.g. [(10,10,10)]
+      resample_channels = dict(fused = False, sink_resolutions = [], slab_planes = 32, processes = 8),
+      cell_detection = cell_detection_parameter,
+      processing = processing_parameter,
+      thresholds = dict(source = None, size = (20,900)),
+      voxelization = dict(radius = (7,7,7), slab_size = 16, processes = 8),
+      #resources of each stage for pipe.run_concurrent - cores, peak memory (GB) and disk bound (io)
+      # conversion is disk bound, resampling uses its processes, elastix is cpu bound,
+      # detection needs memory for its processes blocks (size_max = 100 planes each)
+      resources = dict(
+          convert = dict(cpus = 4, memory = 8, io = 1),
+          resample = dict(cpus = 4, memory = 16),
+          resample_auto = dict(cpus = 4, memory = 16),
+          resample_channels = dict(cpus = 8, memory = 24),
+          align_resampled_to_auto = dict(cpus = 8, memory = 4),
+          align_auto_to_reference = dict(cpus = 8, memory = 4),
+          detect = dict(cpus = 6, memory = 48),
+          filter = dict(cpus = 1, memory = 4),
+          transform = dict(cpus = 1, memory = 4),
+          annotate = dict(cpus = 1, memory = 8),
+          export = dict(cpus = 1, memory = 4, io = 1),
+          voxelize = dict(cpus = 8, memory = 16),
+          ),
+      )
+
+
+def state_file(ws):
+  """The stage state file in the workspace directory."""
+  return os.path.join(ws.directory, 'pipeline_state.json')
+
+
+###############################################################################
+### Stage functions
+###############################################################################
+
+def convert(source, sink):
+  import ClearMap.IO.IO as io
+
+  io.convert(source, sink, processes=None, verbose=True)
+  # write header to view in imageJ
+  io.mhd.write_header_from_source(sink, filename=None, header=None)
+
+
+def convert_zarr(source, sink, chunks, readers, writers):
+  import CI_Zarr as cz
+
+  cz.convert_to_zarr(source, sink, chunks=chunks, readers=readers, writers=writers)
+
+
+def resample(source, sink, parameter):
+  import ClearMap.Alignment.Resampling as res
+
+  res.resample(source, sink=sink, **parameter)
+
+
+def resample_chunked(source, sink, parameter):
+  import CI_Resampling as cres
+
+  cres.resample(source, sink, parameter['source_resolution'], parameter['sink_resolution'],
+                processes=parameter.get('processes'))
+
+
+def resample_channels(sources, sinks, source_resolution, sink_resolutions, slab_planes, processes):
+  import CI_Resampling as cres
+
+  cres.resample_channels(sources, sinks, source_resolution, sink_resolutions, slab_planes=slab_planes,
+                         processes=processes)
+
+
+def resolution_postfix(resolution):
+  """File postfix of a resolution, e.g. (10,10,10) -> '10um', (10,10,20) -> '10x10x20um'."""
+  if len(set(resolution)) == 1:
+    return '%gum' % resolution[0]
+  return 'x'.join('%g' % r for r in resolution) + 'um'
+
+
+def align(parameter):
+  import ClearMap.Alignment.Elastix as elx
+
+  elx.align(**parameter)
+
+
+def detect(source, sink, cell_detection_parameter, processing_parameter):
+  import ClearMap.ImageProcessing.Experts.Cells as cells
+
+  cells.detect_cells(source, sink, cell_detection_parameter=cell_detection_parameter,
+                     processing_parameter=processing_parameter)
+
+
+def detect_chunked(source, sink, cell_detection_parameter, processing_parameter, block_planes):
+  import CI_Zarr as cz
+
+  cz.detect_cells_chunked(source, sink, cell_detection_parameter, processing_parameter, block_planes=block_planes)
+
+
+def filter_cells(source, sink, thresholds):
+  import ClearMap.ImageProcessing.Experts.Cells as cells
+
+  cells.filter_cells(source=source, sink=sink, thresholds=thresholds)
+
+
+def transform(source, sink, stitched, resampled, resampled_to_auto, auto_to_reference):
+  """Transform the filtered cell coordinates to the atlas (resampling and both alignments)."""
+  import ClearMap.IO.IO as io
+  import ClearMap.Alignment.Resampling as res
+  import ClearMap.Alignment.Elastix as elx
+  import CI_Zarr as cz
+
+  source = io.as_source(source)
+  coordinates = np.array([source[c] for c in 'xyz']).T
+  coordinates = res.resample_points(coordinates, sink=None, orientation=None,
+                                    source_shape=cz.open_stitched(stitched).shape, sink_shape=io.shape(resampled))
+  coordinates = elx.transform_points(coordinates, sink=None, transform_directory=resampled_to_auto,
+                                     binary=True, indices=False)
+  coordinates = elx.transform_points(coordinates, sink=None, transform_directory=auto_to_reference,
+                                     binary=True, indices=False)
+  io.write(sink, np.asarray(coordinates, dtype=float))
+
+
+def annotate(source, transformed, sink, regions, annotation_file):
+  """Merge the filtered cells, transformed coordinates, order and id into the cells file."""
+  import numpy.lib.recfunctions as rfn
+  import ClearMap.IO.IO as io
+  import CI_Annotation as can
+
+  coordinates = np.ascontiguousarray(io.as_source(transformed)[:], dtype=float)
+  region_lookup = can.region_lookup()
+  order, ids = can.annotate_points(coordinates, region_lookup, annotation_file=annotation_file)
+
+  coordinates.dtype = [(t,float) for t in ('xt','yt','zt')]
+  order = np.array(order, dtype=[('order', np.int32)])
+  ids = np.array(ids, dtype=[('id', np.int32)])
+  cells_data = rfn.merge_arrays([io.as_source(source)[:], coordinates, order, ids], flatten=True, usemask=False)
+  io.write(sink, cells_data)
+  can.write_region_table(regions, region_lookup)
+
+
+def export(source, sink, csv_sink):
+  import ClearMap.IO.IO as io
+  import CI_Annotation as can
+  import CI_Cell_Export as cex
+
+  region_lookup = can.region_lookup()
+  cex.export_cells(io.as_source(source), sink, region_lookup)
+  cex.export_csv(io.as_source(source), csv_sink, region_lookup)
+
+
+def voxelize(source, outputs, annotation_file, slab_size=16, processes=None):
+  import ClearMap.IO.IO as io
+  import CI_Voxelization as cvox
+
+  source = io.as_source(source)
+  coordinates = np.array([source[n] for n in ['xt','yt','zt']]).T
+  cvox.voxelize(coordinates, io.shape(annotation_file), outputs, weights=source['source'],
+                slab_size=slab_size, processes=processes)
+
+
+###############################################################################
+### Stage graph
+###############################################################################
+
+def cellmap_stages(ws, annotation_file, reference_file, parameters=None, resources_directory=None, group=None):
+  """The CellMap stages of one brain.
+
+  Arguments
+  ---------
+  ws : Workspace
+    The ClearMap workspace with the raw and autofluorescence expressions.
+  annotation_file, reference_file : str
+    The atlas files from ano.prepare_annotation_files.
+  parameters : dict or None
+    The stage parameters (default_parameters()).
+  resources_directory : str or None
+    ClearMap resources with the elastix parameter files (None = settings.resources_path).
+  group : str or None
+    Stage group, e.g. the brain name when several brains are run together.
+
+  Returns
+  -------
+  stages : list of Stage
+  """
+  if parameters is None:
+    parameters = default_parameters()
+  if resources_directory is None:
+    import ClearMap.Settings as settings
+    resources_directory = settings.resources_path
+  align_affine_file = os.path.join(resources_directory, 'Alignment/align_affine.txt')
+  align_bspline_file = os.path.join(resources_directory, 'Alignment/align_bspline.txt')
+
+  raw = ws.filename('raw')
+  autofluorescence = ws.filename('autofluorescence')
+  zarr = parameters['stitched']['format'] == 'zarr'
+  stitched = ws.filename('stitched', extension='zarr') if zarr else ws.filename('stitched')
+  resampled = ws.filename('resampled')
+  resampled_auto = ws.filename('resampled', postfix='autofluorescence')
+  resampled_to_auto = ws.filename('resampled_to_auto')
+  auto_to_reference = ws.filename('auto_to_reference')
+  cells_raw = ws.filename('cells', postfix='raw')
+  cells_filtered = ws.filename('cells', postfix='filtered')
+  cells_transformed = ws.filename('cells', postfix='transformed')
+  cells_file = ws.filename('cells')
+  regions = ws.filename('cells', postfix='regions', extension='csv')
+  voxelization = parameters['voxelization']
+  density_outputs = [dict(radius = voxelization['radius'],
+                          counts = ws.filename('density', postfix='counts'),
+                          intensities = ws.filename('density', postfix='intensities'))]
+
+  align_channels_parameter = dict(
+      moving_image = resampled_auto, fixed_image = resampled,
+      affine_parameter_file = align_affine_file, bspline_parameter_file = None,
+      result_directory = resampled_to_auto)
+  align_reference_parameter = dict(
+      moving_image = reference_file, fixed_image = resampled_auto,
+      affine_parameter_file = align_affine_file, bspline_parameter_file = align_bspline_file,
+      result_directory = auto_to_reference)
+
+  fused = parameters.get('resample_channels', {}).get('fused', False)
+  if fused:
+    channels = parameters['resample_channels']
+    extra = [tuple(r) for r in channels['sink_resolutions']]
+    channel_sinks = [[resampled] + [ws.filename('resampled', postfix=resolution_postfix(r)) for r in extra],
+                     [resampled_auto] + [ws.filename('resampled', postfix='autofluorescence_' + resolution_postfix(r))
+                                         for r in extra]]
+    resample_stages = [
+        Stage('resample_channels', resample_channels,
+              dict(sources=[stitched, autofluorescence], sinks=channel_sinks,
+                   source_resolution=parameters['resample']['source_resolution'],
+                   sink_resolutions=[parameters['resample']['sink_resolution']] + extra,
+                   slab_planes=channels['slab_planes'], processes=channels['processes']),
+              inputs=[stitched, autofluorescence], outputs=[f for c in channel_sinks for f in c])]
+  else:
+    resample_stages = [
+        Stage('resample', resample_chunked if zarr else resample,
+              dict(source=stitched, sink=resampled, parameter=parameters['resample']),
+              inputs=[stitched], outputs=[resampled]),
+        Stage('resample_auto', resample, dict(source=autofluorescence, sink=resampled_auto,
+                                              parameter=parameters['resample_auto']),
+              inputs=[autofluorescence], outputs=[resampled_auto])]
+
+  if zarr:
+    chunked = parameters['stitched']
+    convert_stage = Stage('convert', convert_zarr, dict(source=raw, sink=stitched, chunks=chunked['chunks'],
+                                                        readers=chunked['readers'], writers=chunked['writers']),
+                          inputs=[raw], outputs=[stitched])
+    detect_function, detect_kwargs = detect_chunked, dict(block_planes=chunked['block_planes'])
+  else:
+    convert_stage = Stage('convert', convert, dict(source=raw, sink=stitched), inputs=[raw], outputs=[stitched])
+    detect_function, detect_kwargs = detect, {}
+
+  stages = [convert_stage] + resample_stages + [
+      Stage('align_resampled_to_auto', align, dict(parameter=align_channels_parameter),
+            inputs=[resampled_auto, resampled, align_affine_file], outputs=[resampled_to_auto]),
+      Stage('align_auto_to_reference', align, dict(parameter=align_reference_parameter),
+            inputs=[reference_file, resampled_auto, align_affine_file, align_bspline_file],
+            outputs=[auto_to_reference]),
+      Stage('detect', detect_function, dict(source=stitched, sink=cells_raw,
+                                            cell_detection_parameter=parameters['cell_detection'],
+                                            processing_parameter=parameters['processing'], **detect_kwargs),
+            inputs=[stitched], outputs=[cells_raw]),
+      Stage('filter', filter_cells, dict(source=cells_raw, sink=cells_filtered, thresholds=parameters['thresholds']),
+            inputs=[cells_raw], outputs=[cells_filtered]),
+      Stage('transform', transform, dict(source=cells_filtered, sink=cells_transformed, stitched=stitched,
+                                         resampled=resampled, resampled_to_auto=resampled_to_auto,
+                                         auto_to_reference=auto_to_reference),
+            inputs=[cells_filtered, stitched, resampled, resampled_to_auto, auto_to_reference],
+            outputs=[cells_transformed]),
+      Stage('annotate', annotate, dict(source=cells_filtered, transformed=cells_transformed, sink=cells_file,
+                                       regions=regions, annotation_file=annotation_file),
+            inputs=[cells_filtered, cells_transformed, annotation_file], outputs=[cells_file, regions]),
+      Stage('export', export, dict(source=cells_file, sink=ws.filename('cells', extension='parquet'),
+                                   csv_sink=ws.filename('cells', extension='csv')),
+            inputs=[cells_file], outputs=[ws.filename('cells', extension='parquet'),
+                                          ws.filename('cells', extension='csv')]),
+      Stage('voxelize', voxelize, dict(source=cells_file, outputs=density_outputs, annotation_file=annotation_file,
+                                       slab_size=voxelization['slab_size'], processes=voxelization['processes']),
+            inputs=[cells_file, annotation_file],
+            outputs=[f for o in density_outputs for f in (o['counts'], o['intensities'])]),
+      ]
+
+  for stage in stages:
+    stage.group = group
+    for key, value in parameters.get('resources', {}).get(stage.name, {}).items():
+      setattr(stage, key, value)
+  return stages
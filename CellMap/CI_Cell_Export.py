@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binary cell table export - Cellular Imaging / Zuckerman Institute
+=======
+
+Replaces the csv export with np.savetxt(..., fmt='%s'), which formats every field in python,
+writes large files and relies on the region names being the last column (names can contain
+commas).
+
+The cells are written as a Parquet file in chunks of rows: every field of the cells array as a
+typed column with its own name, plus 'acronym' and 'name' as dictionary columns built from the
+structure order codes and the region lookup (see CI_Annotation.py). The Brainrender readers load
+the columns by name (e.g. xt, yt, zt, id, acronym), so the column order does not matter.
+
+Usage
+-----
+  import CI_Cell_Export as cex
+  cex.export_cells(ws.source('cells'), ws.filename('cells', extension='parquet'), region_lookup)
+
+  # reading back, e.g. with pandas
+  cells = pd.read_parquet('cells.parquet', columns=['xt', 'yt', 'zt', 'id', 'acronym'])
+
+export_csv writes the csv export of CellMap_CI_V1.py (still read by the Brainrender scripts that
+take cells.csv) in the same chunks of rows.
+
+Requires pyarrow.
+
+@author: Luke Hammond
+"""
+
+import numpy as np
+
+
+def region_dictionary(lookup, value):
+  """Arrow dictionary (one entry per structure order) for the acronym or name column."""
+  import pyarrow as pa
+
+  return pa.array([str(v) for v in lookup[value]], type=pa.string())
+
+
+def cell_batch(cells, dictionaries):
+  """Arrow record batch of a block of the cells structured array plus the region dictionary columns."""
+  import pyarrow as pa
+
+  columns = [pa.array(np.ascontiguousarray(cells[name])) for name in cells.dtype.names]
+  names = list(cells.dtype.names)
+  if dictionaries:
+    order = pa.array(np.ascontiguousarray(cells['order'], dtype=np.int32))
+    for value, dictionary in dictionaries.items():
+      columns.append(pa.DictionaryArray.from_arrays(order, dictionary))
+      names.append(value)
+  return pa.RecordBatch.from_arrays(columns, names=names)
+
+
+def export_cells(source, filename, lookup=None, chunk_size=1000000, compression='zstd', verbose=True):
+  """Write a cells structured array to a Parquet file in chunks of rows.
+
+  Arguments
+  ---------
+  source : array or ClearMap source
+    The cells structured array (e.g. ws.source('cells')), read chunk by chunk.
+  filename : str
+    The Parquet file.
+  lookup : dict or None
+    The region lookup (CI_Annotation.region_lookup) - adds 'acronym' and 'name' dictionary
+    columns for the 'order' field.
+  chunk_size : int
+    Number of rows written at once (one Parquet row group per chunk).
+
+  Returns
+  -------
+  filename : str
+    The written file.
+  """
+  import pyarrow.parquet as pq
+
+  dictionaries = {}
+  if lookup is not None:
+    dictionaries = dict((value, region_dictionary(lookup, value)) for value in ('acronym', 'name') if value in lookup)
+  n = source.shape[0]
+  writer = None
+  try:
+    for start in range(0, max(n, 1), chunk_size):
+      batch = cell_batch(np.asarray(source[start:start + chunk_size]), dictionaries)
+      if writer is None:
+        writer = pq.ParquetWriter(filename, batch.schema, compression=compression)
+      writer.write_batch(batch)
+      if verbose:
+        print('Cell export: %d of %d cells' % (min(start + chunk_size, n), n))
+  finally:
+    if writer is not None:
+      writer.close()
+  return filename
+
+
+def export_csv(source, filename, lookup, chunk_size=1000000, verbose=True):
+  """Write a cells structured array to csv in chunks of rows, as the CellMap csv export.
+
+  The 'acronym' and 'name' columns are expanded from the 'order' field and appended last (names
+  can contain commas). The header holds the first letter of each column name.
+  """
+  import numpy.lib.recfunctions as rfn
+
+  n = source.shape[0]
+  with open(filename, 'w') as f:
+    for start in range(0, max(n, 1), chunk_size):
+      cells = np.asarray(source[start:start + chunk_size])
+      values = [lookup[value][cells['order']].astype(str) for value in ('acronym', 'name')]
+      export = rfn.append_fields(cells, ['acronym', 'name'], values, usemask=False)
+      header = ', '.join([h[0] for h in export.dtype.names]) if start == 0 else ''
+      np.savetxt(f, export, header=header, delimiter=',', fmt='%s')
+      if verbose:
+        print('Cell export: %d of %d cells' % (min(start + chunk_size, n), n))
+  return filename
@@ -0,0 +1,643 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Out-of-core voxelwise group statistics - Cellular Imaging / Zuckerman Institute
+=======
+
+Replaces reading whole groups with stat.read_group followed by np.mean / np.std and
+stat.t_test_voxelization (which reads the groups a second time).
+
+The group volumes (e.g. density_counts.tif) are memory mapped and processed in slabs of
+planes. For each slab every file is read once, the group mean and variance are accumulated
+with Welford updates, and the mean, std, t-test p-value and p-value colour maps of the slab
+are written straight into memory mapped output files - one pass over the data, with memory
+use set by the slab size rather than the number of brains.
+
+Volumes are processed in file order (planes first) and the outputs keep the layout of the
+input files.
+
+GroupAccumulator keeps the sum and sum of squares of a group on disk with a manifest of the
+included files, so brains can be added to or removed from a growing cohort by reading only
+their own volume; accumulated_statistics derives the same outputs from two accumulators.
+
+permutation_test gives family-wise error corrected p-values from random relabellings of the
+brains, with max-statistic correction of the voxel t values or of their threshold-free cluster
+enhancement (TFCE). The permutations are computed in worker processes sharing the group data.
+
+Usage
+-----
+  import CI_Group_Statistics as gs
+  gs.group_statistics(group1, group2, output_dir, p_cutoff=0.05)
+  gs.accumulated_statistics(gs.GroupAccumulator(acc1).sync(group1),
+                            gs.GroupAccumulator(acc2).sync(group2), output_dir)
+  gs.permutation_test(group1, group2, output_dir, n_permutations=1000, correction='max', seed=0)
+
+@author: Luke Hammond
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import tifffile
+
+
+def open_volume(filename):
+  """Memory map a tif volume, reading it if it can not be mapped (e.g. compressed)."""
+  try:
+    return tifffile.memmap(filename, mode='r')
+  except ValueError:
+    return tifffile.imread(filename)
+
+
+def create_volume(filename, shape, dtype, **kwargs):
+  """Create a memory mapped tif file to write results into."""
+  return tifffile.memmap(filename, shape=shape, dtype=dtype, **kwargs)
+
+
+def welford_slab(sources, slab):
+  """Mean, sum of squared deviations (M2) and count of a group for one slab.
+
+  Arguments
+  ---------
+  sources : list of arrays
+    The memory mapped group volumes.
+  slab : slice
+    The planes to process.
+  """
+  mean = None
+  for n, source in enumerate(sources, start=1):
+    x = np.asarray(source[slab], dtype=np.float64)
+    if mean is None:
+      mean = np.zeros_like(x)
+      m2 = np.zeros_like(x)
+    delta = x - mean
+    mean += delta / n
+    m2 += delta * (x - mean)
+  return mean, m2, len(sources)
+
+
+def t_test(mean1, m2_1, n1, mean2, m2_2, n2, remove_nan=True):
+  """Two sample t-test with equal variances (as stat.t_test_voxelization) from group moments."""
+  from scipy import stats
+
+  df = n1 + n2 - 2
+  pooled = (m2_1 + m2_2) / df
+  with np.errstate(divide='ignore', invalid='ignore'):
+    tvals = (mean1 - mean2) / np.sqrt(pooled * (1.0 / n1 + 1.0 / n2))
+  pvals = 2 * stats.t.sf(np.abs(tvals), df)
+  if remove_nan:
+    nan = np.isnan(pvals)
+    pvals[nan] = 1.0
+    tvals[nan] = 0
+  return tvals, pvals
+
+
+def color_p_values(pvals, psign, p_max, positive=(0, 1), negative=(1, 0)):
+  """Colour p-values as stat.color_p_values, with the maximal p-value given (p_cutoff).
+
+  Returns an array with the colour channels as the second axis (planes, colours, ...).
+  """
+  pinv = p_max - pvals
+  colors = np.zeros((pvals.shape[0], len(positive)) + pvals.shape[1:], dtype=np.float32)
+  for sign, color in ((1, positive), (-1, negative)):
+    ids = psign == sign
+    for i, c in enumerate(color):
+      colors[:, i][ids] = pinv[ids] * c
+  return colors
+
+
+def write_group_statistics(moments1, moments2, shape, output_dir, p_cutoff=0.05, slab_size=16,
+                           positive=(0, 1), negative=(1, 0), verbose=True):
+  """Write the mean, std and p-value colour maps of two groups, slab by slab.
+
+  moments1 and moments2 return the mean, sum of squared deviations (M2) and count of a group
+  for a slab of planes (welford_slab or GroupAccumulator.moments).
+  """
+  filenames = dict((name, os.path.join(output_dir, name + '.tif')) for name in
+                   ('group1_mean', 'group1_std', 'group2_mean', 'group2_std', 'pvalues'))
+  sinks = dict((name, create_volume(filenames[name], shape, np.float64)) for name in
+               ('group1_mean', 'group1_std', 'group2_mean', 'group2_std'))
+  sinks['pvalues'] = create_volume(filenames['pvalues'], (shape[0], len(positive)) + shape[1:], np.float32,
+                                   metadata={'axes': 'ZCYX'})
+
+  for start in range(0, shape[0], slab_size):
+    slab = slice(start, min(start + slab_size, shape[0]))
+    mean1, m2_1, n1 = moments1(slab)
+    mean2, m2_2, n2 = moments2(slab)
+    sinks['group1_mean'][slab] = mean1
+    sinks['group1_std'][slab] = np.sqrt(m2_1 / n1)
+    sinks['group2_mean'][slab] = mean2
+    sinks['group2_std'][slab] = np.sqrt(m2_2 / n2)
+
+    tvals, pvals = t_test(mean1, m2_1, n1, mean2, m2_2, n2)
+    pvals = np.minimum(pvals, p_cutoff)
+    sinks['pvalues'][slab] = color_p_values(pvals, np.sign(tvals), p_cutoff, positive, negative)
+    if verbose:
+      print('Group statistics: planes %d-%d of %d' % (slab.start, slab.stop, shape[0]))
+
+  for sink in sinks.values():
+    sink.flush()
+  return filenames
+
+
+def group_statistics(group1, group2, output_dir, p_cutoff=0.05, slab_size=16, positive=(0, 1), negative=(1, 0),
+                     verbose=True):
+  """Mean, std, p-value and p-value colour maps of two groups in one pass over the data.
+
+  Arguments
+  ---------
+  group1, group2 : list of str
+    The volume files (e.g. density_counts.tif) of each group.
+  output_dir : str
+    Folder for group1_mean.tif, group1_std.tif, group2_mean.tif, group2_std.tif and pvalues.tif.
+  p_cutoff : float
+    p-values above the cut off are set to the cut off (as stat.cutoff_p_values).
+  slab_size : int
+    Number of planes processed at once.
+
+  Returns
+  -------
+  filenames : dict
+    The written files.
+
+  Note
+  ----
+  pvalues.tif holds the two colour channels of stat.color_p_values as a (planes, 2, rows, columns)
+  float32 stack, the same colouring as stat.color_p_values(pvals, psign, positive, negative).
+  """
+  sources1 = [open_volume(f) for f in group1]
+  sources2 = [open_volume(f) for f in group2]
+  shape = sources1[0].shape
+  for f, s in zip(group1 + group2, sources1 + sources2):
+    if s.shape != shape:
+      raise ValueError('Volume %s has shape %r, expected %r' % (f, s.shape, shape))
+
+  return write_group_statistics(lambda slab: welford_slab(sources1, slab), lambda slab: welford_slab(sources2, slab),
+                                shape, output_dir, p_cutoff, slab_size, positive, negative, verbose)
+
+
+###############################################################################
+### Incremental group accumulators
+###############################################################################
+
+def file_hash(filename, block_size=2**24):
+  """blake2b digest of a file's contents."""
+  digest = hashlib.blake2b(digest_size=20)
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def file_record(filename):
+  """Content hash, size and modification time of a file, as recorded by GroupAccumulator."""
+  stat = os.stat(filename)
+  return dict(hash=file_hash(filename), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+class GroupAccumulator(object):
+  """Per-group sum and sum of squares volumes on disk, updated one brain at a time.
+
+  The accumulator folder holds sum.npy and sum_sq.npy (float64, memory mapped) and
+  manifest.json listing the included files with their content hash, size and modification
+  time. Adding or removing a brain reads only that brain's volume.
+
+  A file regenerated in place, or deleted, can not be subtracted (its added values are gone),
+  so sync rebuilds the sums from the current files when it finds one.
+
+  Arguments
+  ---------
+  path : str
+    The accumulator folder, created if needed.
+  slab_size : int
+    Number of planes updated at once.
+  """
+
+  def __init__(self, path, slab_size=16):
+    self.path = path
+    self.slab_size = slab_size
+    os.makedirs(path, exist_ok=True)
+    try:
+      with open(self.filename('manifest.json')) as f:
+        self.manifest = json.load(f)
+    except FileNotFoundError:
+      self.manifest = dict(shape=None, files={}, updating=None)
+    if self.manifest['updating'] is not None:
+      raise RuntimeError('Accumulator %s was interrupted while updating %s - delete the folder and rebuild it' %
+                         (path, self.manifest['updating']))
+    #manifests of earlier versions recorded only the hash
+    for key, record in self.manifest['files'].items():
+      if not isinstance(record, dict):
+        self.manifest['files'][key] = dict(hash=record, size=None, mtime_ns=None)
+
+  def filename(self, name):
+    return os.path.join(self.path, name)
+
+  @property
+  def count(self):
+    return len(self.manifest['files'])
+
+  @property
+  def files(self):
+    return list(self.manifest['files'])
+
+  def _write_manifest(self):
+    tmp = self.filename('manifest.json.tmp')
+    with open(tmp, 'w') as f:
+      json.dump(self.manifest, f, indent=1)
+    os.replace(tmp, self.filename('manifest.json'))
+
+  def _sums(self, shape=None):
+    if self.manifest['shape'] is None:
+      self.manifest['shape'] = list(shape)
+      for name in ('sum.npy', 'sum_sq.npy'):
+        np.lib.format.open_memmap(self.filename(name), mode='w+', dtype=np.float64, shape=tuple(shape)).flush()
+    if shape is not None and tuple(shape) != tuple(self.manifest['shape']):
+      raise ValueError('Volume has shape %r, accumulator %s has shape %r' % (shape, self.path, self.manifest['shape']))
+    return [np.load(self.filename(name), mmap_mode='r+') for name in ('sum.npy', 'sum_sq.npy')]
+
+  def _update(self, filename, sign):
+    source = open_volume(filename)
+    total, total_sq = self._sums(source.shape)
+    self.manifest['updating'] = filename
+    self._write_manifest()
+    for start in range(0, source.shape[0], self.slab_size):
+      slab = slice(start, min(start + self.slab_size, source.shape[0]))
+      x = np.asarray(source[slab], dtype=np.float64)
+      total[slab] += sign * x
+      total_sq[slab] += sign * x * x
+    total.flush()
+    total_sq.flush()
+    self.manifest['updating'] = None
+
+  def add(self, filename):
+    """Add a brain's volume to the group."""
+    key = os.path.abspath(filename)
+    if key in self.manifest['files']:
+      raise ValueError('%s is already in accumulator %s' % (key, self.path))
+    record = file_record(filename)
+    self._update(filename, 1)
+    self.manifest['files'][key] = record
+    self._write_manifest()
+
+  def remove(self, filename):
+    """Remove a brain's volume from the group - the file must be unchanged since it was added."""
+    key = os.path.abspath(filename)
+    if key not in self.manifest['files']:
+      raise ValueError('%s is not in accumulator %s' % (key, self.path))
+    if not os.path.exists(key):
+      raise ValueError('%s was deleted, so it can not be removed from %s - rebuild the accumulator with '
+                       'sync(filenames) or rebuild(filenames)' % (key, self.path))
+    if self.changed(key):
+      raise ValueError('%s changed since it was added to %s - rebuild the accumulator with sync(filenames) or '
+                       'rebuild(filenames)' % (key, self.path))
+    self._update(filename, -1)
+    del self.manifest['files'][key]
+    self._write_manifest()
+
+  def changed(self, filename):
+    """True if an included file is missing or its contents changed since it was added."""
+    key = os.path.abspath(filename)
+    record = self.manifest['files'][key]
+    try:
+      stat = os.stat(key)
+    except FileNotFoundError:
+      return True
+    if stat.st_size == record['size'] and stat.st_mtime_ns == record['mtime_ns']:
+      return False
+    if file_hash(key) != record['hash']:
+      return True
+    #same contents (e.g. copied or touched) - keep the new size and time
+    record.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    self._write_manifest()
+    return False
+
+  def rebuild(self, filenames, verbose=True):
+    """Reset the sums and add the given files."""
+    for name in ('sum.npy', 'sum_sq.npy'):
+      if os.path.exists(self.filename(name)):
+        os.remove(self.filename(name))
+    self.manifest = dict(shape=None, files={}, updating=None)
+    self._write_manifest()
+    for filename in filenames:
+      if verbose:
+        print('Group accumulator %s: adding %s' % (self.path, os.path.abspath(filename)))
+      self.add(filename)
+    return self
+
+  def sync(self, filenames, rebuild=True, verbose=True):
+    """Add and remove brains so the group holds exactly the given files.
+
+    Included files that were regenerated in place, and removed files that were deleted, can not
+    be updated one by one - the sums are then rebuilt from the given files (rebuild=True) or a
+    ValueError lists them (rebuild=False).
+    """
+    keys = [os.path.abspath(f) for f in filenames]
+    changed = [key for key in self.files if key in keys and self.changed(key)]
+    deleted = [key for key in self.files if key not in keys and not os.path.exists(key)]
+    if changed or deleted:
+      message = ', '.join(['%s (changed)' % key for key in changed] + ['%s (deleted)' % key for key in deleted])
+      if not rebuild:
+        raise ValueError('Accumulator %s can not be updated for %s - sync with rebuild=True' % (self.path, message))
+      if verbose:
+        print('Group accumulator %s: rebuilding for %s' % (self.path, message))
+      return self.rebuild(keys, verbose=verbose)
+    for key in self.files:
+      if key not in keys:
+        if verbose:
+          print('Group accumulator %s: removing %s' % (self.path, key))
+        self.remove(key)
+    for key in keys:
+      if key not in self.manifest['files']:
+        if verbose:
+          print('Group accumulator %s: adding %s' % (self.path, key))
+        self.add(key)
+    return self
+
+  def moments(self, slab):
+    """Mean, sum of squared deviations (M2) and count for one slab (as welford_slab)."""
+    n = self.count
+    if n == 0:
+      raise ValueError('Accumulator %s is empty' % self.path)
+    total, total_sq = self._sums()
+    s = np.asarray(total[slab])
+    mean = s / n
+    m2 = np.maximum(np.asarray(total_sq[slab]) - s * mean, 0)
+    return mean, m2, n
+
+
+def accumulated_statistics(accumulator1, accumulator2, output_dir, p_cutoff=0.05, slab_size=16,
+                           positive=(0, 1), negative=(1, 0), verbose=True):
+  """Mean, std, p-value and p-value colour maps from two group accumulators.
+
+  Writes the same files as group_statistics, reading only the accumulator sums.
+  """
+  shape = tuple(accumulator1.manifest['shape'])
+  if tuple(accumulator2.manifest['shape']) != shape:
+    raise ValueError('Accumulators have shapes %r and %r' % (shape, tuple(accumulator2.manifest['shape'])))
+
+  return write_group_statistics(accumulator1.moments, accumulator2.moments, shape, output_dir, p_cutoff,
+                                slab_size, positive, negative, verbose)
+
+
+###############################################################################
+### Permutation tests
+###############################################################################
+
+# Worker state - group data in shared memory, attached once per worker process
+_shared = {}
+
+
+def load_masked_groups(group1, group2, slab_size=16):
+  """Read all volumes once and keep the voxels that are non-zero in any brain.
+
+  Returns
+  -------
+  data : array (brains, voxels)
+    float32 values of the masked voxels, group1 brains first.
+  mask : array
+    Boolean volume of the kept voxels.
+  """
+  sources = [open_volume(f) for f in group1 + group2]
+  shape = sources[0].shape
+  mask = np.zeros(shape, dtype=bool)
+  columns = []
+  for start in range(0, shape[0], slab_size):
+    slab = slice(start, min(start + slab_size, shape[0]))
+    values = np.stack([np.asarray(s[slab], dtype=np.float32) for s in sources])
+    mask[slab] = values.any(axis=0)
+    columns.append(values[:, mask[slab]])
+  return np.concatenate(columns, axis=1), mask
+
+
+def permutation_labels(n1, n2, n_permutations, seed=0):
+  """Group 1 membership (permutations, brains) - the first row is the observed labelling."""
+  rng = np.random.default_rng(seed)
+  labels = np.zeros((n_permutations + 1, n1 + n2), dtype=np.float64)
+  labels[0, :n1] = 1
+  for p in range(1, n_permutations + 1):
+    labels[p, rng.permutation(n1 + n2)[:n1]] = 1
+  return labels
+
+
+def batch_t(labels, data, total, total_sq, n1, n2):
+  """t statistics of all label rows for a block of voxels, as two matrix products.
+
+  Arguments
+  ---------
+  labels : array (permutations, brains)
+  data : array (brains, voxels)
+  total, total_sq : array (voxels,)
+    Precomputed per-voxel sums of values and squared values over all brains.
+  """
+  m1 = labels @ np.asarray(data, dtype=np.float64)
+  m2 = total - m1
+  m1 /= n1
+  m2 /= n2
+  #pooled sum of squares from the sums of squares over all brains: q1 + q2 - n1 m1^2 - n2 m2^2
+  #(in place - at most four (permutations, voxels) arrays at a time, see chunk_voxels)
+  pooled = m1 * m1
+  pooled *= -n1
+  pooled += total_sq
+  squares = m2 * m2
+  squares *= n2
+  pooled -= squares
+  del squares
+  np.maximum(pooled, 0, out=pooled)
+  pooled *= (1.0 / n1 + 1.0 / n2) / (n1 + n2 - 2)
+  np.sqrt(pooled, out=pooled)
+  m1 -= m2
+  with np.errstate(divide='ignore', invalid='ignore'):
+    m1 /= pooled
+  m1[~np.isfinite(m1)] = 0
+  return m1
+
+
+def chunk_voxels(n_rows, n_brains, memory):
+  """Number of voxels per block of batch_t for label rows within memory (GB) per process."""
+  #four float64 (rows, voxels) temporaries plus the float64 block of values
+  return max(1, int(memory * 2**30 / (8 * (4 * n_rows + n_brains))))
+
+
+def tfce(tmap, E=0.5, H=2, dh=0.1):
+  """Threshold-free cluster enhancement of a signed statistic volume (6-connected clusters)."""
+  from scipy import ndimage
+
+  enhanced = np.zeros(tmap.shape, dtype=np.float32)
+  for sign in (1, -1):
+    values = sign * tmap
+    top = values.max()
+    for h in np.arange(dh, top + dh, dh):
+      labels, n = ndimage.label(values >= h)
+      if n == 0:
+        break
+      sizes = np.bincount(labels.ravel())
+      sizes[0] = 0
+      enhanced += sign * (sizes[labels] ** E * h ** H * dh).astype(np.float32)
+  return enhanced
+
+
+def _attach(name, shape, totals_name, labels, n1, n2, chunk_size, tfce_parameter):
+  from multiprocessing import shared_memory
+
+  memory = shared_memory.SharedMemory(name=name)
+  totals_memory = shared_memory.SharedMemory(name=totals_name)
+  data = np.ndarray(shape, dtype=np.float32, buffer=memory.buf)
+  totals = np.ndarray((2, shape[1]), dtype=np.float64, buffer=totals_memory.buf)
+  _shared.update(memory=memory, totals_memory=totals_memory, data=data, labels=labels, n1=n1, n2=n2,
+                 chunk_size=chunk_size, total=totals[0], total_sq=totals[1], tfce=tfce_parameter)
+
+
+def _max_t_chunk(bounds):
+  """Worker: max |t| over a block of voxels for every label row, and the observed t of the block."""
+  a, b = bounds
+  s = _shared
+  t = batch_t(s['labels'], s['data'][:, a:b], s['total'][a:b], s['total_sq'][a:b], s['n1'], s['n2'])
+  return a, np.abs(t).max(axis=1), t[0].astype(np.float32)
+
+
+def _max_tfce_batch(rows):
+  """Worker: max |TFCE| over the brain for a batch of label rows."""
+  s = _shared
+  mask = s['mask']
+  n = s['data'].shape[1]
+  tvals = np.empty((len(rows), n), dtype=np.float32)
+  for a in range(0, n, s['chunk_size']):
+    b = min(a + s['chunk_size'], n)
+    tvals[:, a:b] = batch_t(s['labels'][rows], s['data'][:, a:b], s['total'][a:b], s['total_sq'][a:b],
+                            s['n1'], s['n2'])
+  maxima = []
+  for t in tvals:
+    volume = np.zeros(mask.shape, dtype=np.float32)
+    volume[mask] = t
+    maxima.append(np.abs(tfce(volume, **s['tfce'])).max())
+  return rows, np.array(maxima)
+
+
+def _attach_tfce(name, shape, totals_name, labels, n1, n2, mask, chunk_size, tfce_parameter):
+  _attach(name, shape, totals_name, labels, n1, n2, chunk_size, tfce_parameter)
+  _shared['mask'] = mask
+
+
+def permutation_test(group1, group2, output_dir, n_permutations=1000, correction='max', seed=0,
+                     processes=None, memory=None, chunk_size=None, batch_size=8, p_cutoff=0.05,
+                     positive=(0, 1), negative=(1, 0), tfce_parameter=None, verbose=True):
+  """Voxelwise permutation test with family-wise error correction.
+
+  Arguments
+  ---------
+  group1, group2 : list of str
+    The volume files (e.g. density_counts.tif) of each group.
+  output_dir : str
+    Folder for tstatistic.tif, pvalues_corrected.tif and pvalues_corrected_color.tif.
+  n_permutations : int
+    Number of random label permutations.
+  correction : 'max' or 'tfce'
+    'max' - max-statistic correction of the voxel t values.
+    'tfce' - threshold-free cluster enhancement of the t map, max-statistic corrected.
+  seed : int
+    Seed of the permutations - results are reproducible for the same seed.
+  processes : int or None
+    Number of worker processes (None = all cores).
+  memory : float or None
+    Memory in GB for the t blocks of all workers (None = half of the physical memory).
+  chunk_size : int or None
+    Number of voxels per block of the t matrix products (None = the largest block within memory
+    divided by processes, for all n_permutations + 1 label rows).
+  batch_size : int
+    Number of permutations per worker task for 'tfce'.
+  tfce_parameter : dict or None
+    E, H and dh of the TFCE (default E=0.5, H=2, dh=0.1).
+
+  Returns
+  -------
+  filenames : dict
+    The written files.
+
+  Note
+  ----
+  The group volumes are loaded once (voxels that are zero in all brains are dropped) into shared
+  memory used by all workers. For each block of voxels, the t values of all permutations are
+  computed from one matrix product of the (permutations x brains) label matrix with the values,
+  using the per-voxel sums of values and squared values over all brains, computed once and shared
+  with the workers.
+  """
+  import multiprocessing
+  from multiprocessing import shared_memory
+
+  tfce_parameter = dict(E=0.5, H=2, dh=0.1, **(tfce_parameter or {}))
+  n1, n2 = len(group1), len(group2)
+  data, mask = load_masked_groups(group1, group2)
+  labels = permutation_labels(n1, n2, n_permutations, seed)
+  if verbose:
+    print('Permutation test: %d brains, %d voxels, %d permutations' % (n1 + n2, data.shape[1], n_permutations))
+
+  processes = processes or os.cpu_count()
+  if chunk_size is None:
+    if memory is None:
+      memory = 0.5 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30
+    chunk_size = chunk_voxels(n_permutations + 1, n1 + n2, memory / processes)
+
+  shared_data = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+  shared_totals = shared_memory.SharedMemory(create=True, size=max(16 * data.shape[1], 1))
+  try:
+    shared = np.ndarray(data.shape, dtype=np.float32, buffer=shared_data.buf)
+    shared[:] = data
+    del data
+    n = shared.shape[1]
+    #per-voxel sums over all brains, computed once for all workers
+    totals = np.ndarray((2, n), dtype=np.float64, buffer=shared_totals.buf)
+    for a in range(0, n, chunk_size):
+      block = shared[:, a:a + chunk_size].astype(np.float64)
+      totals[0, a:a + chunk_size] = block.sum(axis=0)
+      totals[1, a:a + chunk_size] = np.einsum('ij,ij->j', block, block)
+    context = multiprocessing.get_context('spawn')
+    names = (shared_data.name, shared.shape, shared_totals.name)
+
+    #observed t values and max-statistic null distribution over voxel blocks
+    tobs = np.zeros(n, dtype=np.float32)
+    maxima = np.zeros(n_permutations + 1)
+    blocks = [(a, min(a + chunk_size, n)) for a in range(0, n, chunk_size)]
+    with context.Pool(processes, initializer=_attach,
+                      initargs=names + (labels, n1, n2, chunk_size, tfce_parameter)) as pool:
+      for a, block_max, block_t in pool.imap_unordered(_max_t_chunk, blocks):
+        tobs[a:a + len(block_t)] = block_t
+        np.maximum(maxima, block_max, out=maxima)
+
+    tmap = np.zeros(mask.shape, dtype=np.float32)
+    tmap[mask] = tobs
+    if correction == 'max':
+      statistic = np.abs(tobs)
+    elif correction == 'tfce':
+      observed = tfce(tmap, **tfce_parameter)
+      statistic = np.abs(observed[mask])
+      rows = np.arange(n_permutations + 1)
+      batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+      with context.Pool(processes, initializer=_attach_tfce,
+                        initargs=names + (labels, n1, n2, mask, chunk_size, tfce_parameter)) as pool:
+        for done, (batch, batch_max) in enumerate(pool.imap_unordered(_max_tfce_batch, batches), 1):
+          maxima[batch] = batch_max
+          if verbose:
+            print('Permutation test: TFCE batch %d of %d' % (done, len(batches)))
+    else:
+      raise ValueError("correction must be 'max' or 'tfce', got %r" % correction)
+  finally:
+    shared = totals = None
+    for block in (shared_data, shared_totals):
+      block.close()
+      block.unlink()
+
+  #corrected p value - fraction of label rows (including the observed one) with a larger maximum
+  null = np.sort(maxima)
+  pcorr = np.ones(mask.shape, dtype=np.float32)
+  pcorr[mask] = (len(null) - np.searchsorted(null, statistic - 1e-12, side='left')) / len(null)
+
+  filenames = dict((name, os.path.join(output_dir, name + '.tif')) for name in
+                   ('tstatistic', 'pvalues_corrected', 'pvalues_corrected_color'))
+  tifffile.imwrite(filenames['tstatistic'], tmap)
+  tifffile.imwrite(filenames['pvalues_corrected'], pcorr)
+  colors = color_p_values(np.minimum(pcorr, p_cutoff), np.sign(tmap), p_cutoff, positive, negative)
+  tifffile.imwrite(filenames['pvalues_corrected_color'], colors, metadata={'axes': 'ZCYX'})
+  return filenames
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checkpointed stage graph - Cellular Imaging / Zuckerman Institute
+=======
+
+Runs a pipeline as a graph of stages instead of a linear sequence of script cells.
+
+Each stage is a module level function with keyword arguments, the files it reads (inputs)
+and the files or folders it writes (outputs). After a stage finishes, the signatures of its
+inputs and outputs and a digest of its function and arguments are recorded in a state file
+in the workspace. A rerun skips stages whose inputs, arguments and outputs are unchanged and
+resumes from the first invalidated stage - when a stage reruns its outputs change, which
+invalidates the stages that read them.
+
+File signatures are the content hash for files up to HASH_LIMIT bytes, and the size and
+modification time for larger files (e.g. the stitched volume). Folders and ClearMap file
+expressions (e.g. 'Z<Z,4>.ome.tif') are signed by the sorted list of their files.
+
+run_concurrent runs independent stages at the same time in separate processes, within a
+budget of cores, memory (GB) and concurrent disk heavy stages. Each stage declares what it uses
+(cpus, memory, io). Ready stages are started longest remaining path first, using the durations
+recorded in the state file, and smaller stages fill the remaining budget. Stages can belong to
+groups (e.g. brains of a batch) with one state file per group; stages that never ran in a
+group are expected to take the median duration recorded for other groups.
+
+Usage
+-----
+  import CI_Pipeline as pipe
+  stages = [pipe.Stage('resample', res.resample, dict(source=..., sink=..., **parameter),
+                       inputs=[stitched], outputs=[resampled]), ...]
+  pipe.run_stages(stages, os.path.join(directory, 'pipeline_state.json'))
+  pipe.run_concurrent(stages, os.path.join(directory, 'pipeline_state.json'), cpus=32, memory=120)
+
+@author: Luke Hammond
+"""
+
+import concurrent.futures
+import concurrent.futures.process
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+
+#files up to this size are signed by their content hash, larger files by size and time
+HASH_LIMIT = 2**28
+
+
+class Stage(object):
+  """A pipeline stage.
+
+  Arguments
+  ---------
+  name : str
+    Unique name of the stage.
+  function : function
+    Module level function run as function(**kwargs).
+  kwargs : dict
+    Keyword arguments of the function - recorded as the stage parameters.
+  inputs : list of str
+    Files, folders or ClearMap file expressions read by the stage.
+  outputs : list of str
+    Files or folders written by the stage - deleted before the stage runs.
+  depends : list of str
+    Names of stages that have to run first. Stages writing one of the inputs are added
+    automatically.
+  cpus : int
+    Cores used by the stage (e.g. its processes parameter).
+  memory : float
+    Peak memory of the stage in GB.
+  io : int
+    1 for disk bound stages (e.g. conversion), limited separately by run_concurrent.
+  group : str or None
+    Group of the stage, e.g. the brain in a batch - stage names and depends are unique
+    within a group, and each group can have its own state file.
+  """
+
+  def __init__(self, name, function, kwargs=None, inputs=(), outputs=(), depends=(), cpus=1, memory=0, io=0,
+               group=None):
+    self.name = name
+    self.group = group
+    self.function = function
+    self.kwargs = kwargs or {}
+    self.inputs = list(inputs)
+    self.outputs = list(outputs)
+    self.depends = list(depends)
+    self.cpus = cpus
+    self.memory = memory
+    self.io = io
+
+  def __repr__(self):
+    return 'Stage(%r)' % self.id
+
+  @property
+  def id(self):
+    """Unique name of the stage in the graph - group/name for grouped stages."""
+    return self.name if self.group is None else '%s/%s' % (self.group, self.name)
+
+  def depends_ids(self):
+    return [d if self.group is None else '%s/%s' % (self.group, d) for d in self.depends]
+
+  def parameters(self):
+    """Digest of the function and its arguments."""
+    text = json.dumps(dict(function='%s.%s' % (self.function.__module__, self.function.__qualname__),
+                           kwargs=self.kwargs), sort_keys=True, default=repr)
+    return hashlib.blake2b(text.encode(), digest_size=20).hexdigest()
+
+  def run(self):
+    for output in self.outputs:
+      delete(output)
+    return self.function(**self.kwargs)
+
+
+def delete(path):
+  """Delete a file or folder if it exists."""
+  if os.path.isdir(path):
+    shutil.rmtree(path)
+  elif os.path.exists(path):
+    os.remove(path)
+
+
+def expression_glob(expression):
+  """Glob pattern of a ClearMap file expression, e.g. 'Table Z<Z,4>.ome.tif' -> 'Table Z*.ome.tif'."""
+  return re.sub(r'<[^>]*>', '*', expression)
+
+
+def file_signature(filename, hash_limit=HASH_LIMIT):
+  stat = os.stat(filename)
+  if stat.st_size <= hash_limit:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as f:
+      for block in iter(lambda: f.read(2**24), b''):
+        digest.update(block)
+    return 'blake2b:' + digest.hexdigest()
+  return 'stat:%d:%d' % (stat.st_size, stat.st_mtime_ns)
+
+
+def signature(path, hash_limit=HASH_LIMIT):
+  """Signature of a file, folder or file expression, None if it does not exist."""
+  if os.path.isfile(path):
+    return file_signature(path, hash_limit)
+  if os.path.isdir(path):
+    files = sorted(os.path.join(root, f) for root, _, names in os.walk(path) for f in names)
+  else:
+    files = sorted(glob.glob(expression_glob(path)))
+  if not files:
+    return None
+  digest = hashlib.blake2b(digest_size=20)
+  for f in files:
+    stat = os.stat(f)
+    digest.update(('%s:%d:%d;' % (os.path.relpath(f, os.path.dirname(path)), stat.st_size, stat.st_mtime_ns)).encode())
+  return 'files:%d:%s' % (len(files), digest.hexdigest())
+
+
+def order_stages(stages):
+  """Stages in dependency order - dependencies from depends and from outputs read as inputs."""
+  by_id = dict((s.id, s) for s in stages)
+  if len(by_id) != len(stages):
+    raise ValueError('Stage names are not unique')
+  writers = dict((output, s.id) for s in stages for output in s.outputs)
+  requires = dict((s.id, set(s.depends_ids()) | set(writers[i] for i in s.inputs if i in writers) - {s.id})
+                  for s in stages)
+  ordered, done = [], set()
+  while len(ordered) < len(stages):
+    ready = [s for s in stages if s.id not in done and requires[s.id] <= done]
+    if not ready:
+      raise ValueError('Stages have circular or missing dependencies: %r' %
+                       sorted(s.id for s in stages if s.id not in done))
+    for s in ready:
+      ordered.append(s)
+      done.add(s.id)
+  return ordered, requires
+
+
+class StageState(object):
+  """Recorded signatures of the finished stages, kept in a json file in the workspace."""
+
+  def __init__(self, filename):
+    self.filename = filename
+    try:
+      with open(filename) as f:
+        self.stages = json.load(f)
+    except (OSError, ValueError):
+      self.stages = {}
+
+  def save(self):
+    tmp = self.filename + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(self.stages, f, indent=1, sort_keys=True)
+    os.replace(tmp, self.filename)
+
+  def current(self, stage):
+    """Signatures of the stage as it would be recorded now."""
+    return dict(parameters=stage.parameters(),
+                inputs=dict((i, signature(i)) for i in stage.inputs),
+                outputs=dict((o, signature(o)) for o in stage.outputs))
+
+  def is_valid(self, stage):
+    """True if the stage finished before with the same parameters, inputs and outputs."""
+    record = self.stages.get(stage.name)
+    if record is None:
+      return False
+    now = self.current(stage)
+    return (record['parameters'] == now['parameters'] and record['inputs'] == now['inputs'] and
+            record['outputs'] == now['outputs'] and all(v is not None for v in now['outputs'].values()))
+
+  def invalidate(self, stage):
+    self.stages.pop(stage.name, None)
+    self.save()
+
+  def record(self, stage, duration):
+    record = self.current(stage)
+    record.update(finished=time.strftime('%Y-%m-%d %H:%M:%S'), duration=round(duration, 1))
+    self.stages[stage.name] = record
+    self.save()
+
+
+def run_stages(stages, state_file, force=(), until=None, verbose=True):
+  """Run the stages in dependency order, skipping stages that are up to date.
+
+  Arguments
+  ---------
+  stages : list of Stage
+    The pipeline.
+  state_file : str
+    The json file recording the finished stages, e.g. in the workspace directory.
+  force : list of str
+    Names of stages to rerun even if up to date (their dependents rerun as their outputs change).
+  until : str or None
+    Stop after this stage.
+
+  Returns
+  -------
+  ran : list of str
+    Names of the stages that were run.
+  """
+  ordered, requires = order_stages(stages)
+  state = StageState(state_file)
+  ran = []
+  for stage in ordered:
+    if stage.id not in force and not (requires[stage.id] & set(ran)) and state.is_valid(stage):
+      if verbose:
+        print('Pipeline: %s is up to date' % stage.name)
+    else:
+      if verbose:
+        print('Pipeline: running %s' % stage.name)
+      state.invalidate(stage)
+      start = time.time()
+      stage.run()
+      state.record(stage, time.time() - start)
+      ran.append(stage.id)
+      if verbose:
+        print('Pipeline: %s done in %.0fs' % (stage.name, time.time() - start))
+    if stage.id == until:
+      break
+  return ran
+
+
+###############################################################################
+### Concurrent execution
+###############################################################################
+
+def total_memory():
+  """Physical memory in GB."""
+  return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30
+
+
+def _run_stage(stage):
+  start = time.time()
+  stage.run()
+  return time.time() - start
+
+
+def critical_path(stages, requires, durations):
+  """Longest remaining duration from each stage to the end of the graph (durations by stage id)."""
+  dependents = dict((s.id, [t.id for t in stages if s.id in requires[t.id]]) for s in stages)
+  path = {}
+  for s in reversed(stages):
+    path[s.id] = durations[s.id] + max([path[d] for d in dependents[s.id]] or [0])
+  return path
+
+
+def stage_durations(stages, states):
+  """Expected duration of each stage - as recorded for the stage, or the median recorded for stages
+  of the same name in other groups (e.g. other brains), 1 if never run."""
+  recorded = {}
+  for state in states.values():
+    for name, record in state.stages.items():
+      recorded.setdefault(name, []).append(record.get('duration', 1))
+  durations = {}
+  for s in stages:
+    record = states[s.group].stages.get(s.name)
+    if record is not None:
+      durations[s.id] = record.get('duration', 1)
+    else:
+      durations[s.id] = float(np.median(recorded[s.name])) if s.name in recorded else 1
+  return durations
+
+
+def run_concurrent(stages, state_file, cpus=None, memory=None, io=1, force=(), raise_errors=True, progress=None,
+                   verbose=True):
+  """Run the stages concurrently within a resource budget, skipping stages that are up to date.
+
+  Arguments
+  ---------
+  stages : list of Stage
+    The pipeline.
+  state_file : str or dict
+    The json file recording the finished stages, or a dict group -> state file for grouped stages.
+  cpus : int or None
+    Cores available (None = all cores).
+  memory : float or None
+    Memory available in GB (None = 90% of the physical memory).
+  io : int
+    Number of disk bound stages run at the same time.
+  force : list of str
+    Ids of stages to rerun even if up to date.
+  raise_errors : bool
+    Raise an error at the end if a stage failed.
+  progress : function or None
+    Called as progress(stage, status) when a stage is skipped, started, finished or failed.
+
+  Returns
+  -------
+  status : dict
+    Stage id -> 'skipped' (up to date), 'done', 'failed: <error>' or 'not run' (a dependency failed).
+
+  Note
+  ----
+  A stage needing more than the whole budget runs when nothing else is running. When a stage
+  fails, the stages depending on it are not run, and all other stages continue. Each stage runs
+  in its own worker process, so a stage process that is killed (e.g. out of memory) only fails
+  that stage.
+  """
+  ordered, requires = order_stages(stages)
+  by_id = dict((s.id, s) for s in ordered)
+  cpus = cpus or os.cpu_count()
+  memory = memory or 0.9 * total_memory()
+  if isinstance(state_file, dict):
+    states = dict((group, StageState(f)) for group, f in state_file.items())
+  else:
+    state = StageState(state_file)
+    states = dict((s.group, state) for s in ordered)
+  path = critical_path(ordered, requires, stage_durations(ordered, states))
+
+  status, ran = {}, set()
+  running = {}
+  free = dict(cpus=cpus, memory=memory, io=io)
+
+  def fits(stage):
+    if not running:
+      return True
+    return stage.cpus <= free['cpus'] and stage.memory <= free['memory'] and stage.io <= free['io']
+
+  def take(stage, sign):
+    for key in free:
+      free[key] -= sign * getattr(stage, key)
+
+  def report(stage, message):
+    if progress is not None:
+      progress(stage, message)
+    if verbose:
+      print('Pipeline: %s %s' % (stage.id, message))
+
+  #one single worker executor per stage - a killed worker breaks only the executor of its stage
+  context = multiprocessing.get_context('spawn')
+  executors = {}
+  try:
+    while len(status) < len(ordered):
+      #resolve stages whose dependencies are finished - skip up to date stages, drop failed branches
+      changed = True
+      while changed:
+        changed = False
+        for stage in ordered:
+          sid = stage.id
+          if sid in status or sid in running.values() or not all(r in status for r in requires[sid]):
+            continue
+          if any(status[r] not in ('skipped', 'done') for r in requires[sid]):
+            status[sid] = 'not run'
+            changed = True
+            report(stage, 'not run')
+          elif sid not in force and not (requires[sid] & ran) and states[stage.group].is_valid(stage):
+            status[sid] = 'skipped'
+            changed = True
+            report(stage, 'is up to date')
+
+      ready = [s for s in ordered if s.id not in status and s.id not in running.values() and
+               all(status.get(r) in ('skipped', 'done') for r in requires[s.id])]
+      for stage in sorted(ready, key=lambda s: -path[s.id]):
+        if fits(stage):
+          states[stage.group].invalidate(stage)
+          take(stage, 1)
+          executor = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context)
+          future = executor.submit(_run_stage, stage)
+          running[future], executors[future] = stage.id, executor
+          report(stage, 'running (%d cpus, %.0f GB)' % (stage.cpus, stage.memory))
+
+      if not running:
+        continue
+      finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in finished:
+        stage = by_id[running.pop(future)]
+        take(stage, -1)
+        executors.pop(future).shutdown(wait=False)
+        try:
+          duration = future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+          status[stage.id] = 'failed: stage process terminated (killed or out of memory)'
+          report(stage, status[stage.id])
+          continue
+        except Exception as error:
+          status[stage.id] = 'failed: %s: %s' % (type(error).__name__, error)
+          report(stage, status[stage.id])
+          continue
+        states[stage.group].record(stage, duration)
+        status[stage.id] = 'done'
+        ran.add(stage.id)
+        report(stage, 'done in %.0fs' % duration)
+  finally:
+    for executor in executors.values():
+      executor.shutdown(wait=True)
+
+  failed = [sid for sid, s in status.items() if s.startswith('failed')]
+  if failed and raise_errors:
+    raise RuntimeError('Pipeline stages failed: %s' % ', '.join('%s (%s)' % (n, status[n][8:]) for n in failed))
+  return status
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Slab-wise, multi-channel resampling - Cellular Imaging / Zuckerman Institute
+=======
+
+Resamples volumes (the npy or Zarr stitched volume from CI_Zarr.py, which res.resample can not
+read, or a raw plane series such as the autofluorescence) from source_resolution to one or
+more sink resolutions, reading the source one slab of z planes at a time.
+
+The resampling plan is computed once from the source shape and resolutions: one sparse weight
+matrix per axis and sink resolution (linear interpolation as res.resample, or area averaging)
+and the slabs of source planes with the sink planes each slab produces, for every sink
+resolution. The slabs are resampled in a process pool - each worker reads a slab once,
+resamples it along z, then x and y, and writes the planes of every sink resolution into
+memory mapped outputs.
+
+resample_channels applies the plan to several channels in the same pass (e.g. the stitched
+and autofluorescence channels, which are acquired at the same resolution), instead of one
+res.resample run per channel and resolution. Channels of a different shape get their own
+plan.
+
+Usage
+-----
+  import CI_Resampling as cres
+  cres.resample(ws.filename('stitched', extension='zarr'), ws.filename('resampled'),
+                source_resolution=(4.0625, 4.0625, 3), sink_resolution=(25,25,25))
+
+  cres.resample_channels([ws.filename('stitched'), ws.filename('autofluorescence')],
+                         [[ws.filename('resampled'), ws.filename('resampled', postfix='10um')],
+                          [ws.filename('resampled', postfix='autofluorescence'),
+                           ws.filename('resampled', postfix='autofluorescence_10um')]],
+                         source_resolution=(4.0625, 4.0625, 3),
+                         sink_resolutions=[(25,25,25), (10,10,10)], processes=8)
+
+@author: Luke Hammond
+"""
+
+import numpy as np
+import tifffile
+
+from CI_Voxelization import create_sink, open_sink
+from CI_Zarr import open_stitched, plane_files, read_plane
+
+
+###############################################################################
+### Sources
+###############################################################################
+
+class PlaneSeries(object):
+  """(x, y, z) view of a series of tif planes - indexing reads only the planes of the region."""
+
+  def __init__(self, files):
+    self.files = list(files)
+    first = read_plane(self.files[0])
+    self.shape = first.shape[::-1] + (len(self.files),)
+    self.dtype = first.dtype
+    self.ndim = 3
+
+  def __getitem__(self, slicing):
+    if not isinstance(slicing, tuple):
+      slicing = (slicing,)
+    slicing = slicing + (slice(None),) * (self.ndim - len(slicing))
+    z = range(self.shape[2])[slicing[2]]
+    if isinstance(z, int):
+      return read_plane(self.files[z])[slicing[1], slicing[0]].T
+    planes = np.stack([read_plane(self.files[i])[slicing[1], slicing[0]] for i in z])
+    return planes.T
+
+
+def open_volume(source):
+  """(x, y, z) array of a source - ClearMap plane expression, tif, Zarr or npy."""
+  if '<' in source:
+    return PlaneSeries(plane_files(source))
+  if source.endswith('.tif') or source.endswith('.tiff'):
+    return tifffile.memmap(source, mode='r').T
+  return open_stitched(source)
+
+
+###############################################################################
+### Resampling plan
+###############################################################################
+
+def axis_weights(n_in, n_out, interpolation='linear'):
+  """Sparse (n_out, n_in) matrix resampling one axis.
+
+  'linear' interpolates between the two nearest source voxels (pixel centers as cv2.resize),
+  'area' averages the source voxels covered by each output voxel.
+  """
+  from scipy import sparse
+
+  scale = n_in / n_out
+  if interpolation == 'linear':
+    position = np.clip((np.arange(n_out) + 0.5) * scale - 0.5, 0, n_in - 1)
+    i0 = np.floor(position).astype(int)
+    i1 = np.minimum(i0 + 1, n_in - 1)
+    w = position - i0
+    rows = np.repeat(np.arange(n_out), 2)
+    cols = np.stack([i0, i1], axis=1).ravel()
+    values = np.stack([1 - w, w], axis=1).ravel()
+  elif interpolation == 'area':
+    start, stop = np.arange(n_out) * scale, (np.arange(n_out) + 1) * scale
+    first, last = np.floor(start).astype(int), np.minimum(np.ceil(stop).astype(int), n_in)
+    rows = np.concatenate([np.full(l - f, o) for o, (f, l) in enumerate(zip(first, last))])
+    cols = np.concatenate([np.arange(f, l) for f, l in zip(first, last)])
+    values = (np.minimum(cols + 1, stop[rows]) - np.maximum(cols, start[rows])) / scale
+  else:
+    raise ValueError("interpolation must be 'linear' or 'area', got %r" % interpolation)
+  return sparse.csr_matrix((values, (rows, cols)), shape=(n_out, n_in), dtype=np.float32)
+
+
+def sink_shape(source_shape, source_resolution, sink_resolution):
+  """Shape of the resampled volume (at least one voxel per axis)."""
+  return tuple(int(max(1, round(s * a / b))) for s, a, b in zip(source_shape, source_resolution, sink_resolution))
+
+
+def resampling_plan(source_shape, source_resolution, sink_resolutions, slab_planes=32, interpolation='linear'):
+  """Weights and slabs for resampling a volume of source_shape (x, y, z) to several resolutions.
+
+  The source is cut into slabs of slab_planes planes. A sink plane belongs to the slab holding
+  the first source plane it uses, and each slab is read with the few extra planes its last
+  sink planes need.
+
+  Returns
+  -------
+  plan : dict
+    'shapes' - the sink shape per resolution, 'weights' - the x, y and z weight matrices per
+    resolution, 'slabs' - tuples (first source plane, last source plane + 1, [(first sink plane,
+    last sink plane + 1) per resolution]).
+  """
+  shapes = [sink_shape(source_shape, source_resolution, r) for r in sink_resolutions]
+  weights = [[axis_weights(n_in, n_out, interpolation) for n_in, n_out in zip(source_shape, shape)]
+             for shape in shapes]
+
+  #source planes used by each sink plane
+  support = []
+  for wx, wy, wz in weights:
+    coo = wz.tocoo()
+    first = np.full(wz.shape[0], wz.shape[1])
+    last = np.zeros(wz.shape[0], dtype=int)
+    np.minimum.at(first, coo.row, coo.col)
+    np.maximum.at(last, coo.row, coo.col)
+    support.append((first, last))
+
+  slabs = []
+  for z0 in range(0, source_shape[2], slab_planes):
+    z1 = min(z0 + slab_planes, source_shape[2])
+    ranges = [tuple(int(o) for o in np.searchsorted(first, [z0, z1])) for first, _ in support]
+    used = [(first[o0], last[o1 - 1] + 1) for (first, last), (o0, o1) in zip(support, ranges) if o1 > o0]
+    if used:
+      slabs.append((int(min(a for a, _ in used)), int(max(b for _, b in used)), ranges))
+  return dict(source_shape=tuple(source_shape), source_resolution=tuple(source_resolution),
+              sink_resolutions=[tuple(r) for r in sink_resolutions], shapes=shapes, weights=weights,
+              slabs=slabs)
+
+
+###############################################################################
+### Resampling
+###############################################################################
+
+def apply_axis(weights, block, axis):
+  """Resample one axis of a block with a (n_out, n_in) weight matrix."""
+  moved = np.moveaxis(block, axis, 0)
+  result = weights @ moved.reshape(moved.shape[0], -1)
+  return np.moveaxis(np.asarray(result).reshape((weights.shape[0],) + moved.shape[1:]), 0, axis)
+
+
+def resample_slab(block, weights, planes, first_plane):
+  """Resample a block of source planes (starting at first_plane) to the sink planes (o0, o1).
+
+  z is resampled first, adding the weighted source planes one at a time (this shrinks the block
+  most without a float copy of it), then x and y.
+  """
+  o0, o1 = planes
+  wx, wy, wz = weights
+  wz = wz[o0:o1].tocoo()
+  result = np.zeros(block.shape[:2] + (o1 - o0,), dtype=np.float32)
+  for o, i, w in zip(wz.row, wz.col, wz.data):
+    if w != 0:
+      result[:, :, o] += w * block[:, :, i - first_plane]
+  result = apply_axis(wx, result, 0)
+  return apply_axis(wy, result, 1)
+
+
+def cast(values, dtype):
+  """Cast resampled values to the sink type, rounding and clipping for integer types."""
+  dtype = np.dtype(dtype)
+  if dtype.kind in 'iu':
+    info = np.iinfo(dtype)
+    values = np.clip(np.rint(values), info.min, info.max)
+  return values.astype(dtype)
+
+
+_state = {}
+
+
+def _attach(sources, sinks, plans, plan_index):
+  _state.update(volumes=[open_volume(s) for s in sources],
+                sinks=[[open_sink(f) for f in channel] for channel in sinks],
+                plans=plans, plan_index=plan_index)
+
+
+def _resample_slab(task):
+  """Worker: read the source planes of a slab of one channel once and write every sink resolution."""
+  channel, k = task
+  s = _state
+  volume = s['volumes'][channel]
+  plan = s['plans'][s['plan_index'][channel]]
+  a, b, ranges = plan['slabs'][k]
+  block = np.asarray(volume[:, :, a:b])
+  for weights, planes, sink in zip(plan['weights'], ranges, s['sinks'][channel]):
+    if planes[1] > planes[0]:
+      sink[:, :, planes[0]:planes[1]] = cast(resample_slab(block, weights, planes, a), volume.dtype)
+      sink.flush()
+  return channel, a, b
+
+
+def resample_channels(sources, sinks, source_resolution, sink_resolutions, slab_planes=32, processes=None,
+                      interpolation='linear', verbose=True):
+  """Resample several channels to several resolutions in one pass over the source data.
+
+  Arguments
+  ---------
+  sources : list of str
+    The channel volumes - ClearMap plane expressions (e.g. ws.filename('autofluorescence')),
+    tif, Zarr or npy files - all at source_resolution.
+  sinks : list of list of str
+    For each channel, one output file per sink resolution (tif as ClearMap, or npy).
+  source_resolution : tuple
+    Voxel size (x, y, z) of the sources.
+  sink_resolutions : list of tuple
+    Voxel sizes (x, y, z) of the outputs, e.g. [(25,25,25), (10,10,10)].
+  slab_planes : int
+    Number of source planes per task.
+  processes : int or None
+    Number of worker processes (None = all cores).
+  interpolation : 'linear' or 'area'
+
+  Returns
+  -------
+  sinks : list of list of str
+    The resampled volumes.
+  """
+  import multiprocessing
+
+  if len(sinks) != len(sources) or any(len(s) != len(sink_resolutions) for s in sinks):
+    raise ValueError('Give one sink per sink resolution for each source')
+
+  #one plan per distinct source shape
+  plans, plan_index, tasks = [], [], []
+  shapes = {}
+  for channel, (source, channel_sinks) in enumerate(zip(sources, sinks)):
+    volume = open_volume(source)
+    shape = tuple(int(s) for s in volume.shape)
+    if shape not in shapes:
+      shapes[shape] = len(plans)
+      plans.append(resampling_plan(shape, source_resolution, sink_resolutions, slab_planes, interpolation))
+    plan_index.append(shapes[shape])
+    plan = plans[shapes[shape]]
+    for sink, shape_out in zip(channel_sinks, plan['shapes']):
+      create_sink(sink, shape_out, volume.dtype)
+    tasks.append([(channel, k) for k in range(len(plan['slabs']))])
+    if verbose:
+      print('Resampling: %s %r -> %s' % (source, shape, ', '.join('%r' % (s,) for s in plan['shapes'])))
+
+  #interleave the channels so all sources are streamed together slab by slab
+  common = min(len(t) for t in tasks)
+  tasks = [t for slab in zip(*tasks) for t in slab] + [t for channel_tasks in tasks for t in channel_tasks[common:]]
+
+  with multiprocessing.get_context('spawn').Pool(processes, initializer=_attach,
+                                                 initargs=(sources, sinks, plans, plan_index)) as pool:
+    for i, (channel, a, b) in enumerate(pool.imap_unordered(_resample_slab, tasks), 1):
+      if verbose:
+        print('Resampling: channel %d planes %d-%d, %d of %d slabs' % (channel, a, b, i, len(tasks)))
+  return sinks
+
+
+def resample(source, sink, source_resolution, sink_resolution, slab_planes=32, processes=None,
+             interpolation='linear', verbose=True):
+  """Resample one volume slab by slab into a tif or npy sink (see resample_channels).
+
+  Returns
+  -------
+  sink : str
+    The resampled volume.
+  """
+  resample_channels([source], [[sink]], source_resolution, [sink_resolution], slab_planes=slab_planes,
+                    processes=processes, interpolation=interpolation, verbose=verbose)
+  return sink
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel tiled voxelization of cell coordinates - Cellular Imaging / Zuckerman Institute
+=======
+
+Replaces separate vox.voxelize calls for the unweighted and intensity weighted density maps
+(method='sphere'), which each rescan all transformed coordinates.
+
+The points are rounded to the nearest voxel and sorted by z once. The volume is split into
+slabs of z planes, and each slab is processed by a worker process: the points of the slab and
+its halo are binned into count and weight histograms, which are convolved (FFT) with the
+ellipsoid kernel of every requested radius - the same result as adding the kernel at each
+point. The slabs are written straight into memory mapped output files, so memory use is set
+by the slab size and not by the number of cells.
+
+Volumes are indexed as in ClearMap (x, y, z). Tif outputs are written in the ClearMap tif
+layout (z planes as pages), npy outputs as (x, y, z) arrays.
+
+Usage
+-----
+  import CI_Voxelization as cvox
+  cvox.voxelize(coordinates, shape, [dict(radius=(7,7,7), counts='density_counts.tif',
+                                          intensities='density_intensities.tif')],
+                weights=intensities)
+
+@author: Luke Hammond
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tifffile
+
+# Worker state - sorted points and outputs, opened once per worker process
+_state = {}
+
+
+def sphere_kernel(radius, halo=None):
+  """Ellipsoid kernel with the given radii (in voxels), centered in an array of size 2 * halo + 1."""
+  radius = np.asarray(radius, dtype=float)
+  halo = np.asarray(radius if halo is None else halo, dtype=int)
+  grid = np.ogrid[tuple(slice(-h, h + 1) for h in halo)]
+  distance = sum((g / r) ** 2 for g, r in zip(grid, radius))
+  return (distance <= 1).astype(np.float64)
+
+
+def create_sink(filename, shape, dtype):
+  """Create a zero filled memory mapped output volume of shape (x, y, z)."""
+  if filename.endswith('.npy'):
+    sink = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=tuple(shape))
+  else:
+    sink = tifffile.memmap(filename, shape=tuple(shape)[::-1], dtype=dtype)
+  sink.flush()
+  del sink
+
+
+def open_sink(filename):
+  """Memory map an output volume for writing, as an (x, y, z) view."""
+  if filename.endswith('.npy'):
+    return np.load(filename, mmap_mode='r+')
+  return tifffile.memmap(filename, mode='r+').T
+
+
+def sort_points(coordinates, weights, shape, halo):
+  """Round points to voxels, drop points whose kernel misses the volume and sort them by z.
+
+  Returns
+  -------
+  points : array (n, 3)
+    int32 voxel coordinates sorted by z.
+  weights : array or None
+    The weights in the same order.
+  """
+  points = np.rint(np.asarray(coordinates)).astype(np.int64)
+  halo = np.asarray(halo)
+  keep = np.all((points >= -halo) & (points < np.asarray(shape) + halo), axis=1)
+  order = np.flatnonzero(keep)
+  order = order[np.argsort(points[order, 2], kind='stable')]
+  points = points[order].astype(np.int32)
+  if weights is not None:
+    weights = np.asarray(weights, dtype=np.float64)[order]
+  return points, weights
+
+
+def _attach(points_file, weights_file, outputs, shape, halo):
+  _state.update(points=np.load(points_file, mmap_mode='r'),
+                weights=None if weights_file is None else np.load(weights_file, mmap_mode='r'),
+                kernels=[sphere_kernel(o['radius'], halo) for o in outputs],
+                sinks=[dict((key, open_sink(o[key])) for key in ('counts', 'intensities') if o.get(key))
+                       for o in outputs],
+                shape=shape, halo=halo)
+
+
+def _voxelize_slab(task):
+  """Worker: histogram the points of a slab (with halo), convolve with the kernels and write the slab."""
+  from scipy.signal import fftconvolve
+
+  z0, z1, a, b = task
+  s = _state
+  halo = np.asarray(s['halo'])
+  padded = (s['shape'][0] + 2 * halo[0], s['shape'][1] + 2 * halo[1], z1 - z0 + 2 * halo[2])
+  local = s['points'][a:b] + np.array([halo[0], halo[1], halo[2] - z0])
+  index = np.ravel_multi_index(local.T, padded)
+  counts = np.bincount(index, minlength=np.prod(padded)).reshape(padded).astype(np.float64)
+  weighted = None
+  if s['weights'] is not None:
+    weighted = np.bincount(index, weights=s['weights'][a:b], minlength=np.prod(padded)).reshape(padded)
+
+  for kernel, sinks in zip(s['kernels'], s['sinks']):
+    density = np.rint(fftconvolve(counts, kernel, mode='valid'))
+    if 'counts' in sinks:
+      sinks['counts'][:, :, z0:z1] = density
+    if 'intensities' in sinks:
+      intensity = fftconvolve(weighted, kernel, mode='valid')
+      intensity[density == 0] = 0
+      sinks['intensities'][:, :, z0:z1] = intensity
+  for sinks in s['sinks']:
+    for sink in sinks.values():
+      sink.flush()
+  return z0, z1, b - a
+
+
+def voxelize(coordinates, shape, outputs, weights=None, slab_size=16, processes=None,
+             counts_dtype='int32', intensities_dtype='float32', verbose=True):
+  """Count and intensity weighted sphere voxelization for one or more radii in one pass.
+
+  Arguments
+  ---------
+  coordinates : array (n, 3)
+    Point coordinates in voxels (x, y, z), e.g. the transformed cell coordinates.
+  shape : tuple
+    Shape (x, y, z) of the output volumes, e.g. io.shape(annotation_file).
+  outputs : list of dict
+    One dict per radius with keys 'radius' (voxels, as vox.voxelize), 'counts' (output file for
+    the number of points per voxel) and optionally 'intensities' (output file for the summed
+    weights per voxel). Files ending in .npy are written as npy, others as tif.
+  weights : array or None
+    One weight per point (e.g. the cell intensities), required for 'intensities' outputs.
+  slab_size : int
+    Number of z planes per task.
+  processes : int or None
+    Number of worker processes (None = all cores).
+
+  Returns
+  -------
+  outputs : list of dict
+    The outputs.
+  """
+  import multiprocessing
+
+  shape = tuple(int(s) for s in shape)
+  if weights is None and any(o.get('intensities') for o in outputs):
+    raise ValueError('Intensity weighted outputs need weights')
+  halo = tuple(int(np.ceil(max(o['radius'][d] for o in outputs))) for d in range(3))
+  points, weights = sort_points(coordinates, weights, shape, halo)
+  if verbose:
+    print('Voxelization: %d points, %d radii, %d planes' % (len(points), len(outputs), shape[2]))
+
+  for o in outputs:
+    create_sink(o['counts'], shape, counts_dtype)
+    if o.get('intensities'):
+      create_sink(o['intensities'], shape, intensities_dtype)
+
+  #slab tasks - each slab gets its points and those within the kernel halo
+  z = points[:, 2]
+  tasks = []
+  for z0 in range(0, shape[2], slab_size):
+    z1 = min(z0 + slab_size, shape[2])
+    a, b = np.searchsorted(z, [z0 - halo[2], z1 + halo[2]])
+    if b > a:
+      tasks.append((z0, z1, int(a), int(b)))
+
+  folder = tempfile.mkdtemp(prefix='ci_voxelize_')
+  try:
+    points_file = os.path.join(folder, 'points.npy')
+    np.save(points_file, points)
+    weights_file = None
+    if weights is not None:
+      weights_file = os.path.join(folder, 'weights.npy')
+      np.save(weights_file, weights)
+    del points, weights, z
+
+    with multiprocessing.get_context('spawn').Pool(processes, initializer=_attach,
+                                                   initargs=(points_file, weights_file, outputs, shape, halo)) as pool:
+      for i, (z0, z1, n) in enumerate(pool.imap_unordered(_voxelize_slab, tasks), 1):
+        if verbose:
+          print('Voxelization: planes %d-%d (%d points), %d of %d slabs' % (z0, z1, n, i, len(tasks)))
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+  return outputs
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chunked, compressed stitched volumes - Cellular Imaging / Zuckerman Institute
+=======
+
+Alternative to io.convert(source, sink) of the 'Z<Z,4>' OME-TIFF plane series into one
+uncompressed npy file (plus an mhd header for ImageJ).
+
+convert_to_zarr reads the planes with several reader threads, which feed a bounded queue; the
+planes are gathered into blocks of chunk planes and compressed (blosc, zstd) into a Zarr
+array by writer threads. Memory use is set by the queue size and the chunk depth, and the
+volume on disk is compressed.
+
+The Zarr array is stored as planes (z, y, x). open_stitched returns an (x, y, z) view of it
+(as ClearMap arrays) that reads only the chunks of the requested region, so the stitched
+volume can be resampled (CI_Resampling.py) and searched for cells (detect_cells_chunked) block
+by block.
+
+Usage
+-----
+  import CI_Zarr as cz
+  cz.convert_to_zarr(ws.filename('raw'), ws.filename('stitched', extension='zarr'))
+  stitched = cz.open_stitched(ws.filename('stitched', extension='zarr'))
+  cz.detect_cells_chunked(ws.filename('stitched', extension='zarr'), ws.filename('cells', postfix='raw'),
+                          cell_detection_parameter, processing_parameter)
+
+Requires zarr (2.x API) and numcodecs.
+
+@author: Luke Hammond
+"""
+
+import concurrent.futures
+import glob
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import tifffile
+
+
+###############################################################################
+### Conversion
+###############################################################################
+
+def plane_files(expression):
+  """Files of a ClearMap plane expression (e.g. 'Table Z<Z,4>.ome.tif') sorted by their Z tag."""
+  parts = re.split(r'(<[^>]*>)', expression)
+  pattern = ''.join(r'(\d+)' if p.startswith('<') else re.escape(p) for p in parts)
+  matches = []
+  for f in glob.glob(''.join('*' if p.startswith('<') else p for p in parts)):
+    match = re.fullmatch(pattern, f)
+    if match:
+      matches.append((tuple(int(g) for g in match.groups()), f))
+  if not matches:
+    raise ValueError('No files found for %s' % expression)
+  return [f for _, f in sorted(matches)]
+
+
+def read_plane(filename):
+  """Read one plane - is_ome=False, as the planes of a series carry the multi-file OME metadata
+  of the whole series (tifffile would read all planes, as ClearMap with multifile=True)."""
+  return tifffile.imread(filename, is_ome=False)
+
+
+def compressor(cname='zstd', clevel=3):
+  """Blosc compressor with bit shuffle (suited to 16 bit microscopy data)."""
+  from numcodecs import Blosc
+
+  return Blosc(cname=cname, clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+
+
+def convert_to_zarr(source, sink, chunks=(16, 512, 512), cname='zstd', clevel=3, readers=8, writers=4,
+                    queue_size=64, verbose=True):
+  """Convert a plane series to a compressed, chunked Zarr array of shape (z, y, x).
+
+  Arguments
+  ---------
+  source : str or list of str
+    ClearMap file expression of the planes (e.g. ws.filename('raw')) or the list of plane files.
+  sink : str
+    The Zarr folder (e.g. stitched.zarr).
+  chunks : tuple
+    Chunk shape (z, y, x) - planes are written in blocks of chunks[0] planes.
+  readers, writers : int
+    Number of plane reader and block writer threads.
+  queue_size : int
+    Maximal number of planes read but not yet gathered into a block.
+
+  Returns
+  -------
+  sink : str
+    The Zarr folder.
+  """
+  import zarr
+
+  files = plane_files(source) if isinstance(source, str) else list(source)
+  first = read_plane(files[0])
+  depth = chunks[0]
+  shape = (len(files),) + first.shape
+  chunks = (depth,) + tuple(min(c, s) for c, s in zip(chunks[1:], shape[1:]))
+  array = zarr.open(sink, mode='w', shape=shape, chunks=chunks, dtype=first.dtype,
+                    compressor=compressor(cname, clevel))
+
+  planes = queue.Queue(maxsize=queue_size)
+  next_plane = iter(range(len(files)))
+  lock = threading.Lock()
+  failed = []
+
+  def read():
+    while not failed:
+      with lock:
+        z = next(next_plane, None)
+      if z is None:
+        return
+      try:
+        planes.put((z, read_plane(files[z])))
+      except Exception as error:
+        failed.append(error)
+        planes.put((None, None))
+
+  for _ in range(readers):
+    threading.Thread(target=read, daemon=True).start()
+
+  #gather planes into blocks of chunk depth, write complete blocks in the writer threads
+  blocks, counts, pending = {}, {}, []
+  with concurrent.futures.ThreadPoolExecutor(writers) as executor:
+    for _ in range(len(files)):
+      z, plane = planes.get()
+      if z is None:
+        break
+      b = z // depth
+      z0, z1 = b * depth, min((b + 1) * depth, len(files))
+      if b not in blocks:
+        blocks[b] = np.empty((z1 - z0,) + shape[1:], dtype=first.dtype)
+        counts[b] = 0
+      blocks[b][z - z0] = plane
+      counts[b] += 1
+      if counts[b] == z1 - z0:
+        pending.append(executor.submit(array.__setitem__, slice(z0, z1), blocks.pop(b)))
+        if verbose:
+          print('Zarr conversion: planes %d-%d of %d' % (z0, z1, len(files)))
+      #bound the blocks waiting for compression
+      while len(pending) > 2 * writers:
+        pending.pop(0).result()
+    for future in pending:
+      future.result()
+  if failed:
+    raise failed[0]
+  return sink
+
+
+###############################################################################
+### Chunked access
+###############################################################################
+
+class StitchedVolume(object):
+  """(x, y, z) view of a (z, y, x) Zarr volume - indexing reads only the chunks of the region."""
+
+  def __init__(self, array):
+    self.array = array
+
+  @property
+  def shape(self):
+    return tuple(self.array.shape[::-1])
+
+  @property
+  def dtype(self):
+    return self.array.dtype
+
+  @property
+  def ndim(self):
+    return self.array.ndim
+
+  def __getitem__(self, slicing):
+    if not isinstance(slicing, tuple):
+      slicing = (slicing,)
+    slicing = slicing + (slice(None),) * (self.ndim - len(slicing))
+    return np.asarray(self.array[slicing[::-1]]).T
+
+
+def open_stitched(filename):
+  """(x, y, z) array of a stitched volume - a chunked view for Zarr, a memory map for npy."""
+  if filename.rstrip('/').endswith('.zarr'):
+    import zarr
+    return StitchedVolume(zarr.open(filename, mode='r'))
+  return np.load(filename, mmap_mode='r')
+
+
+def detect_cells_chunked(source, sink, cell_detection_parameter, processing_parameter, block_planes=200,
+                         overlap=None, verbose=True):
+  """cells.detect_cells on a Zarr stitched volume, one block of z planes at a time.
+
+  Each block, with overlap planes on both sides, is written to a temporary npy file next to
+  the sink and processed by cells.detect_cells with the given parameters. Cells found in the
+  overlap are dropped (they belong to the neighbouring block) and z is shifted to the volume.
+
+  Arguments
+  ---------
+  source : str
+    The stitched volume (Zarr or npy).
+  sink : str
+    The npy file for the detected cells (as cells.detect_cells).
+  block_planes : int
+    Number of z planes per block.
+  overlap : int or None
+    Planes added on each side of a block (None = processing_parameter['overlap']).
+  """
+  import ClearMap.ImageProcessing.Experts.Cells as cells
+
+  volume = open_stitched(source)
+  if overlap is None:
+    overlap = processing_parameter.get('overlap', 16) or 0
+  nz = volume.shape[2]
+  folder = tempfile.mkdtemp(prefix='ci_detect_', dir=os.path.dirname(os.path.abspath(sink)))
+  results = []
+  try:
+    block_file = os.path.join(folder, 'block.npy')
+    block_cells = os.path.join(folder, 'cells.npy')
+    for z0 in range(0, nz, block_planes):
+      z1 = min(z0 + block_planes, nz)
+      a, b = max(z0 - overlap, 0), min(z1 + overlap, nz)
+      np.save(block_file, np.asfortranarray(volume[:, :, a:b]))
+      cells.detect_cells(block_file, block_cells, cell_detection_parameter=cell_detection_parameter,
+                         processing_parameter=processing_parameter)
+      found = np.load(block_cells)
+      z = found['z'] + a
+      found = found[(z >= z0) & (z < z1)]
+      found['z'] += a
+      results.append(found)
+      if verbose:
+        print('Chunked detection: planes %d-%d of %d, %d cells' % (z0, z1, nz, len(found)))
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+  np.save(sink, np.concatenate(results))
+  return sink
@@ -94,6 +94,34 @@ if __name__ == "__main__":
   align_reference_bspline_file = io.join(resources_directory, 'Alignment/align_bspline.txt')
   
   
+  #%%############################################################################
+  ### Checkpointed pipeline (alternative to running the cells below one by one)
+  ###############################################################################
+  
+  #%% Run all stages: convert -> resample (x2) -> align (x2) -> detect -> filter -> transform -> annotate -> export -> voxelize
+  # finished stages are recorded with their input signatures and parameters in pipeline_state.json in the
+  # workspace - rerunning skips unchanged stages and resumes from the first stage with changed inputs or parameters
+  # (e.g. after a crash during detection, or after changing the filter thresholds)
+  # uncomment to run the pipeline instead of the cells below (which redo every step)
+  
+  #import CI_Pipeline as pipe
+  #import CI_CellMap_Stages as cms
+  
+  #pipeline_parameters = cms.default_parameters()
+  #pipeline_parameters['thresholds']['size'] = (20,900)
+  #pipeline_parameters['stitched']['format'] = 'zarr' # compressed chunked stitched volume (CI_Zarr.py)
+  #pipeline_parameters['resample_channels'].update(fused=True, sink_resolutions=[(10,10,10)]) # one pass resampling
+  #pipeline_stages = cms.cellmap_stages(ws, annotation_file, reference_file, pipeline_parameters,
+  #                                     resources_directory=resources_directory)
+  #pipe.run_stages(pipeline_stages, cms.state_file(ws), force=[], until=None)
+  
+  #%% Or run independent stages concurrently within a core and memory budget
+  # the two resamplings run in parallel, and detection overlaps both elastix alignments
+  # stage resources (cores, memory GB, disk bound) are in pipeline_parameters['resources']
+  
+  #pipe.run_concurrent(pipeline_stages, cms.state_file(ws), cpus=32, memory=120, io=1, force=[])
+  
+  
   #%%############################################################################
   ### Data conversion
   ############################################################################### 
@@ -108,6 +136,18 @@ if __name__ == "__main__":
   # write header to view in imageJ
   io.mhd.write_header_from_source(ws.filename('stitched'), filename=None, header=None)
   
+  #%% Or convert to a compressed, chunked Zarr volume (parallel plane readers and chunk writers)
+  # resample and detect cells on it with the chunked readers (res.resample / cells.detect_cells read npy)
+  
+  #import CI_Zarr as cz
+  #import CI_Resampling as cres
+  #cz.convert_to_zarr(ws.filename('raw'), ws.filename('stitched', extension='zarr'), chunks=(16,512,512),
+  #                   readers=8, writers=4)
+  #cres.resample(ws.filename('stitched', extension='zarr'), ws.filename('resampled'),
+  #              source_resolution=(4.0625, 4.0625, 3), sink_resolution=(25,25,25))
+  #cz.detect_cells_chunked(ws.filename('stitched', extension='zarr'), ws.filename('cells', postfix='raw'),
+  #                        cell_detection_parameter, processing_parameter, block_planes=200)
+  
   
   #%%############################################################################
   ### Resampling and atlas alignment 
@@ -142,6 +182,17 @@ if __name__ == "__main__":
   
   #p3d.plot([ws.filename('resampled'), ws.filename('resampled', postfix='autofluorescence')])
   
+  #%% Or resample both channels in one pass (one resampling plan, z slabs in a process pool),
+  # optionally also at 10um for higher resolution alignment or display
+  
+  #import CI_Resampling as cres
+  #cres.resample_channels([ws.filename('stitched'), ws.filename('autofluorescence')],
+  #                       [[ws.filename('resampled'), ws.filename('resampled', postfix='10um')],
+  #                        [ws.filename('resampled', postfix='autofluorescence'),
+  #                         ws.filename('resampled', postfix='autofluorescence_10um')]],
+  #                       source_resolution=(4.0625, 4.0625, 3), sink_resolutions=[(25,25,25), (10,10,10)],
+  #                       slab_planes=32, processes=8)
+  
   #%% Aignment - resampled to autofluorescence (>2min - update elastix to v5 for improved speed?)
   
   # align the two channels
@@ -322,40 +373,54 @@ if __name__ == "__main__":
  #%% Cell annotation
   # *** by default this script only provides graph order - which may confuse some users after region ID
   # updated to include ID and acronyms
+  # the atlas structures are converted once to dense order -> id / acronym / name lookup arrays and the
+  # points are labelled once - acronym and name are not stored per cell, the order is their code
+  # (previously ano.label_points and three ano.convert_label calls stored as U256 columns)
   
-  label = ano.label_points(coordinates_transformed, key='order');
-  names = ano.convert_label(label, key='order', value='name');
-  ID = ano.convert_label(label, key='order', value='id');
-  acronym = ano.convert_label(label, key='order', value='acronym');
+  import CI_Annotation as can
+  
+  region_lookup = can.region_lookup()
+  label, ID = can.annotate_points(coordinates_transformed, region_lookup)
   
   #%% Save results
-  #adding in ID and acronyms as above
-  #IMPORTANT - names should be final column, as comma seperated names create additional columns and 
-  #will mix entries in columns to the right of the names column
-  # keep in mind, first letter of column name used in output - so "atlas_ID" and "acronym" would be both be save to column "a"
+  #adding in ID as above - acronyms and names are looked up from the order with the region table
+  # region table (order, id, acronym, name) saved next to the cells file
   
   coordinates_transformed.dtype=[(t,float) for t in ('xt','yt','zt')]
-  label = np.array(label, dtype=[('order', int)]);
-  names = np.array(names, dtype=[('name' , 'U256')])
-  ID = np.array(ID, dtype=[('id' , int)])
-  acronym = np.array(acronym, dtype=[('acronym' , 'U256')])
+  label = np.array(label, dtype=[('order', np.int32)]);
+  ID = np.array(ID, dtype=[('id' , np.int32)])
   
   import numpy.lib.recfunctions as rfn
-  cells_data = rfn.merge_arrays([source[:], coordinates_transformed, label, ID, acronym, names], flatten=True, usemask=False)
+  cells_data = rfn.merge_arrays([source[:], coordinates_transformed, label, ID], flatten=True, usemask=False)
   
   io.write(ws.filename('cells'), cells_data)
+  can.write_region_table(ws.filename('cells', postfix='regions', extension='csv'), region_lookup)
     
   
   
   #%%############################################################################
-  ### Cell csv generation for external analysis
+  ### Cell table export for external analysis
   ###############################################################################
   
-  #%% CSV export
+  #%% Parquet export
+  # typed binary table written in chunks - every column keeps its name and type, and acronym and name
+  # are dictionary columns from the order codes, so commas in names can not shift columns
+  # the Brainrender readers (CI_Cell_Loader, CI_Region_Stats) load cells.parquet by column name
   
-  source = ws.source('cells');
-  header = ', '.join([h[0] for h in source.dtype.names]);
-  np.savetxt(ws.filename('cells', extension='csv'), source[:], header=header, delimiter=',', fmt='%s')
+  import CI_Cell_Export as cex
+  
+  cex.export_cells(ws.source('cells'), ws.filename('cells', extension='parquet'), region_lookup,
+                   chunk_size=1000000, verbose=True)
+  
+  #%% CSV export (read by the Brainrender scripts that take cells.csv)
+  
+  #IMPORTANT - names should be final column, as comma seperated names create additional columns and 
+  #will mix entries in columns to the right of the names column
+  # keep in mind, first letter of column name used in output - so "atlas_ID" and "acronym" would be both be save to column "a"
+  # acronym and name columns are expanded from the order codes only for the export, in chunks of rows
+  
+  cex.export_csv(ws.source('cells'), ws.filename('cells', extension='csv'), region_lookup,
+                 chunk_size=1000000, verbose=True)
   
   #%% ClearMap 1.0 export
   
@@ -380,42 +445,26 @@ if __name__ == "__main__":
   coordinates = np.array([source[n] for n in ['xt','yt','zt']]).T;
   intensities = source['source'];
   
-  #%% Unweighted 
-  
-  voxelization_parameter = dict(
-        shape = io.shape(annotation_file), 
-        dtype = None, 
-        weights = None,
-        method = 'sphere', 
-        radius = (7,7,7), 
-        kernel = None, 
-        processes = None, 
-        verbose = True
-      )
+  #%% Unweighted and weighted in one pass
+  # counts and intensity weighted maps (optionally for several radii) from one sort of the points
+  # z slabs are voxelized in parallel worker processes and written straight into the tif files
+  # previously two vox.voxelize calls (weights=None and weights=intensities, method='sphere', radius=(7,7,7))
   
-  vox.voxelize(coordinates, sink=ws.filename('density', postfix='counts'), **voxelization_parameter);
+  import CI_Voxelization as cvox
   
+  voxelization_outputs = [
+      dict(radius = (7,7,7),
+           counts = ws.filename('density', postfix='counts'),
+           intensities = ws.filename('density', postfix='intensities')),
+      #dict(radius = (4,4,4),
+      #     counts = ws.filename('density', postfix='counts_r4'),
+      #     intensities = ws.filename('density', postfix='intensities_r4')),
+      ]
   
-  #%% 
-  
-  #p3d.plot(ws.filename('density', postfix='counts'))
-  
-  
-  #%% Weighted 
-  
-  voxelization_parameter = dict(
-        shape = io.shape(annotation_file),
-        dtype = None, 
-        weights = intensities,
-        method = 'sphere', 
-        radius = (7,7,7), 
-        kernel = None, 
-        processes = None, 
-        verbose = True
-      )
-  
-  vox.voxelize(coordinates, sink=ws.filename('density', postfix='intensities'), **voxelization_parameter);
+  cvox.voxelize(coordinates, io.shape(annotation_file), voxelization_outputs, weights=intensities,
+                slab_size=16, processes=None, verbose=True);
   
   #%%
   
+  #p3d.plot(ws.filename('density', postfix='counts'))
   #p3d.plot(ws.filename('density', postfix='intensities'))
@@ -8,6 +8,8 @@ Created on Wed Aug 18 16:18:33 2021
 Statistics script for ClearMap2
 
 """
+
+if __name__ == "__main__":
      
   #%%############################################################################
   ### Initialization 
@@ -27,6 +29,9 @@ Statistics script for ClearMap2
   from ClearMap.Environment import *  #analysis:ignore
   import ClearMap.Analysis.Statistics.GroupStatistics as stat
   
+  #out-of-core group statistics (in this folder)
+  import CI_Group_Statistics as gs
+  
   #%% Load heat map images - here we are using the example datasets from ClearMap1
   
   
@@ -39,25 +44,39 @@ Statistics script for ClearMap2
            '/home/luke/Desktop/Saline/1274/density_counts.tif'
            ];
 
-  g1 = stat.read_group(group1) # read_group included in t_test_vox function
-  g2 = stat.read_group(group2)
-
-  #%% Create average and standard deviation heatmaps for each group
-  g1m = np.mean(g1,axis = 0)
-  io.tif.write(os.path.join(output_dir,'group1_mean.tif'), g1m)
- 
-  g1s = np.std(g1,axis = 0);
-  io.tif.write(os.path.join(output_dir,'group1_std.tif'), g1s)
-
-  g2m = np.mean(g2,axis = 0)
-  io.tif.write(os.path.join(output_dir,'group2_mean.tif'), g2m)
- 
-  g2s = np.std(g2,axis = 0);
-  io.tif.write(os.path.join(output_dir,'group2_std.tif'), g2s)
-
-  #%% Generate p values
-  pvals, psign = stat.t_test_voxelization(group1, group2, signed=True, remove_nan=True, p_cutoff=0.05)
-  pvalscolor = stat.color_p_values(pvals, psign, positive = [0,1], negative = [1,0])
-  io.tif.write(os.path.join(output_dir,'pvalues.tif'), pvalscolor.astype('float32'))
-  #need to update to change shape.
-  #io.tif.write(os.path.join(output_dir,'pvalues.tif'), pvalscolor[:,:,:,1].astype('float32'))
\ No newline at end of file
+  #%% Create average and standard deviation heatmaps for each group and generate p values
+  # groups are read once, in slabs of planes, instead of loading all brains with stat.read_group
+  # writes group1_mean.tif, group1_std.tif, group2_mean.tif, group2_std.tif and pvalues.tif
+  # pvalues.tif holds the two colour channels of stat.color_p_values as (planes, 2, rows, columns)
+  gs.group_statistics(group1, group2, output_dir, p_cutoff=0.05, slab_size=16,
+                      positive=[0,1], negative=[1,0])
+  
+  #%% Incremental alternative for growing cohorts (optional)
+  # each group keeps its sum and sum of squares on disk with a manifest of the included files
+  # sync only reads brains that were added to or removed from the lists since the last run
+  #acc1 = gs.GroupAccumulator(os.path.join(output_dir, 'group1_accumulator')).sync(group1)
+  #acc2 = gs.GroupAccumulator(os.path.join(output_dir, 'group2_accumulator')).sync(group2)
+  #gs.accumulated_statistics(acc1, acc2, output_dir, p_cutoff=0.05, positive=[0,1], negative=[1,0])
+  
+  #%% Permutation test with family-wise error correction (optional)
+  # correction='max' corrects the voxel t values, correction='tfce' their cluster enhancement
+  # the same seed gives the same permutations and p-values
+  # writes tstatistic.tif, pvalues_corrected.tif and pvalues_corrected_color.tif
+  # memory (GB, default half of the RAM) bounds the t blocks of all worker processes
+  #gs.permutation_test(group1, group2, output_dir, n_permutations=1000, correction='max', seed=0,
+  #                    processes=None, memory=None, p_cutoff=0.05, positive=[0,1], negative=[1,0])
+  
+  #%% Previous in-memory version - reads every volume twice
+  #g1 = stat.read_group(group1)
+  #g2 = stat.read_group(group2)
+  #g1m = np.mean(g1,axis = 0)
+  #io.tif.write(os.path.join(output_dir,'group1_mean.tif'), g1m)
+  #g1s = np.std(g1,axis = 0);
+  #io.tif.write(os.path.join(output_dir,'group1_std.tif'), g1s)
+  #g2m = np.mean(g2,axis = 0)
+  #io.tif.write(os.path.join(output_dir,'group2_mean.tif'), g2m)
+  #g2s = np.std(g2,axis = 0);
+  #io.tif.write(os.path.join(output_dir,'group2_std.tif'), g2s)
+  #pvals, psign = stat.t_test_voxelization(group1, group2, signed=True, remove_nan=True, p_cutoff=0.05)
+  #pvalscolor = stat.color_p_values(pvals, psign, positive = [0,1], negative = [1,0])
+  #io.tif.write(os.path.join(output_dir,'pvalues.tif'), pvalscolor.astype('float32'))